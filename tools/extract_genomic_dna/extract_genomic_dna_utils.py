@@ -1,5 +1,6 @@
 import copy
 import os
+import string
 import subprocess
 import sys
 import tempfile
@@ -9,6 +10,8 @@ from bx.intervals.io import GenomicIntervalReader, NiceReaderWrapper, ParseError
 
 # Default chrom, start, end, strand cols for a bed file
 BED_DEFAULT_COLS = 0, 1, 2, 5
+# Translation table for reverse complement, with IUPAC ambiguity codes
+DNA_COMPLEMENT = string.maketrans("ACGTUMRWSYKVHDBNacgtumrwsykvhdbn", "TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn")
 
 
 class GFFInterval(GenomicInterval):
@@ -411,12 +414,7 @@ def parse_gff_attributes(attr_str):
 
 
 def reverse_complement(s):
-    complement_dna = {"A": "T", "T": "A", "C": "G", "G": "C", "a": "t", "t": "a", "c": "g", "g": "c", "N": "N", "n": "n"}
-    reversed_s = []
-    for i in s:
-        reversed_s.append(complement_dna[i])
-    reversed_s.reverse()
-    return "".join(reversed_s)
+    return s.translate(DNA_COMPLEMENT)[::-1]
 
 
 def stop_err(msg):
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark the steps of genetrack.py on a synthetic chromosome (chr1 sized by
+default), processed in chunks like genetrack.py.
+
+populate: adding each read's normal to the arrays, with the original loop
+          (one slice per read) and with add_normals. Both are checked to give
+          the same arrays (exactly, or within rounding error for the FFT).
+
+Usage: benchmark.py {-length N} {-reads N} {-sigma N} {-seed N}
+"""
+import sys
+import time
+
+import numpy
+import genetrack
+import genetrack_util
+
+CHR1_LENGTH = 248956422
+
+
+def random_reads(length, count, seed=1):
+    """
+    Reads ([index, forward, reverse], sorted by index) at random positions,
+    with more of them in clusters (peaks) than in the background.
+    """
+    rand = numpy.random.RandomState(seed)
+    centers = rand.randint(0, length, count // 20)
+    indexes = numpy.concatenate([rand.randint(1, length, count // 2),
+                                 rand.choice(centers, count - count // 2) + rand.randint(-30, 30, count - count // 2)])
+    indexes = numpy.unique(indexes.clip(1, length))
+    forward = rand.poisson(1.0, len(indexes))
+    reverse = rand.poisson(1.0, len(indexes))
+    return numpy.column_stack([indexes, forward, reverse]).tolist()
+
+
+def orig_populate(forward_array, reverse_array, shift, data, width, normal):
+    'The original populate_array loop'
+    for index, forward, reverse in data:
+        if forward:
+            forward_array[index + shift - width:index + shift + width] += normal * forward
+        if reverse:
+            reverse_array[index + shift - width:index + shift + width] += normal * reverse
+
+
+def populate(forward_array, reverse_array, shift, data, width, normal):
+    'populate_array in process_chromosome'
+    reads = numpy.array(data, numpy.int64).reshape(-1, 3)
+    genetrack_util.add_normals(forward_array, reads[:, 0] + (shift - width), reads[:, 1], normal)
+    genetrack_util.add_normals(reverse_array, reads[:, 0] + (shift - width), reads[:, 2], normal)
+
+
+def benchmark(data, sigma, out=sys.stdout):
+    width = sigma * 5
+    normal = genetrack_util.normal_array(width, sigma)
+    keys = genetrack_util.make_keys(data)
+    lo, hi = genetrack_util.get_range(data)
+    out.write('%s reads, %s bp, sigma %s\n' % (len(data), hi - lo, sigma))
+
+    times = [0.0, 0.0]
+    errors = 0
+    for (slice_start, slice_end), process_bounds in genetrack_util.get_chunks(lo, hi, size=genetrack.CHUNK_SIZE, overlap=width):
+        window = genetrack_util.get_window(data, slice_start, slice_end, keys)
+        if not window:
+            continue
+        arrays = []
+        for i, func in enumerate([orig_populate, populate]):
+            forward_array, shift = genetrack_util.allocate_array(window, width)
+            reverse_array, shift = genetrack_util.allocate_array(window, width)
+            start = time.time()
+            func(forward_array, reverse_array, shift, window, width, normal)
+            times[i] += time.time() - start
+            arrays.append(numpy.concatenate([forward_array, reverse_array]))
+        if not numpy.allclose(arrays[0], arrays[1], rtol=0, atol=1e-11 * arrays[0].max()):
+            errors += 1
+
+    out.write('    populate    orig: %7.2f s    add_normals: %7.2f s    (%.1fx)\n' % (times[0], times[1], times[0] / times[1]))
+    if errors:
+        out.write('    ERROR: add_normals gave different arrays for %s chunks!\n' % errors)
+
+
+if __name__ == '__main__':
+    length = CHR1_LENGTH
+    num_reads = 2000000
+    sigma = 5
+    seed = 1
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-length':
+            length = int(arg)
+            last = None
+        elif last == '-reads':
+            num_reads = int(arg)
+            last = None
+        elif last == '-sigma':
+            sigma = int(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif arg in ['-length', '-reads', '-sigma', '-seed']:
+            last = arg
+        else:
+            print __doc__
+            sys.exit(1)
+
+    benchmark(random_reads(length, num_reads, seed=seed), sigma)
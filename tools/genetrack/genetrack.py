@@ -5,13 +5,72 @@ Input: either scidx or gff format of reads
 Output: Called peaks in gff format
 """
 import optparse
+import collections
 import csv
+import multiprocessing
 import os
+import resource
 import genetrack_util
 
 CHUNK_SIZE = 10000000
 
 
+def work_units(loader, width, options):
+    """
+    Yields the arguments to process_chromosome (except the writer) for each
+    chunk of each chromosome, with the reads sliced to the chunk.
+    """
+    for cname, data in loader:
+        if not len(data):
+            continue
+        keys = data['index']
+        lo, hi = genetrack_util.get_range(data)
+        for chunk in genetrack_util.get_chunks(lo, hi, size=CHUNK_SIZE, overlap=width):
+            (slice_start, slice_end), process_bounds = chunk
+            window = genetrack_util.get_window(data, slice_start, slice_end, keys)
+            yield (cname,
+                   window,
+                   process_bounds,
+                   width,
+                   options.sigma,
+                   options.up_width,
+                   options.down_width,
+                   options.exclusion,
+                   options.filter)
+
+
+def process_chunk(unit):
+    """
+    Processes a work unit in a worker process. Returns the rows to write, the
+    worker's pid and its peak memory use (in KB).
+    """
+    rows = genetrack_util.RowList()
+    genetrack_util.process_chromosome(unit[0], unit[1], rows, *unit[2:])
+    return rows, os.getpid(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def process_parallel(pool, units, writer, processes, worker_memory):
+    """
+    Processes the work units in the pool, and writes the results in order.
+    Only a few units per process are queued at a time, so only those units'
+    reads are held in memory.
+    """
+    pending = collections.deque()
+
+    def write_next():
+        rows, pid, maxrss = pending.popleft().get()
+        writer.writerows(rows)
+        worker_memory[pid] = max(maxrss, worker_memory.get(pid, 0))
+
+    for unit in units:
+        # Each unit carries only its chunk of the reads (a slice of the array)
+        pending.append(pool.apply_async(process_chunk, (unit,)))
+        if len(pending) > processes * 2:
+            write_next()
+    while pending:
+        write_next()
+
+
 if __name__ == '__main__':
     parser = optparse.OptionParser()
     parser.add_option('-t', '--input_format', dest='input_format', type='string', help='Input format')
@@ -21,16 +80,18 @@ if __name__ == '__main__':
     parser.add_option('-u', '--up_width', dest='up_width', type='int', default=10, help='Upstream width of called peaks.')
     parser.add_option('-d', '--down_width', dest='down_width', type='int', default=10, help='Downstream width of called peaks.')
     parser.add_option('-f', '--filter', dest='filter', type='int', default=1, help='Absolute read filter.')
+    parser.add_option('-p', '--processes', dest='processes', type='int', default=1, help='Number of processes to call peaks with.')
+    parser.add_option('-m', '--memory', dest='memory', type='int', default=genetrack_util.LOADER_MEMORY // (1024 * 1024), help='Memory (MB) for loading reads before they are spilled to disk.')
     options, args = parser.parse_args()
 
+    # Start the workers before any reads are loaded, so they don't inherit them
+    pool = None
+    worker_memory = {}
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes)
+
     os.mkdir('output')
     for (dataset_path, hid) in options.inputs:
-        if options.input_format == 'gff':
-            # Make sure the reads for each chromosome are sorted by index.
-            input_path = genetrack_util.sort_chromosome_reads_by_index(dataset_path)
-        else:
-            # We're processing scidx data.
-            input_path = dataset_path
         output_name = 's%se%su%sd%sF%s_on_data_%s' % (options.sigma,
                                                       options.exclusion,
                                                       options.up_width,
@@ -38,28 +99,19 @@ if __name__ == '__main__':
                                                       options.filter,
                                                       hid)
         output_path = os.path.join('output', output_name)
-        reader = csv.reader(open(input_path, 'rU'), delimiter='\t')
         writer = csv.writer(open(output_path, 'wt'), delimiter='\t')
         width = options.sigma * 5
-        manager = genetrack_util.ChromosomeManager(reader)
-        while not manager.done:
-            cname = manager.chromosome_name()
-            # Should we process this chromosome?
-            data = manager.load_chromosome()
-            if not data:
-                continue
-            keys = genetrack_util.make_keys(data)
-            lo, hi = genetrack_util.get_range(data)
-            for chunk in genetrack_util.get_chunks(lo, hi, size=CHUNK_SIZE, overlap=width):
-                (slice_start, slice_end), process_bounds = chunk
-                window = genetrack_util.get_window(data, slice_start, slice_end, keys)
-                genetrack_util.process_chromosome(cname,
-                                                  window,
-                                                  writer,
-                                                  process_bounds,
-                                                  width,
-                                                  options.sigma,
-                                                  options.up_width,
-                                                  options.down_width,
-                                                  options.exclusion,
-                                                  options.filter)
+        # The reads for each chromosome, sorted by index
+        loader = genetrack_util.ReadLoader(dataset_path, options.input_format, options.memory * 1024 * 1024)
+        units = work_units(loader, width, options)
+        if pool:
+            process_parallel(pool, units, writer, options.processes, worker_memory)
+        else:
+            for unit in units:
+                genetrack_util.process_chromosome(unit[0], unit[1], writer, *unit[2:])
+
+    if pool:
+        pool.close()
+        pool.join()
+        for pid, maxrss in sorted(worker_memory.items()):
+            print 'Worker %s peak memory: %.1f MB' % (pid, maxrss / 1024.0)
@@ -2,13 +2,35 @@ import bisect
 import math
 import numpy
 import re
-import subprocess
 import sys
 import tempfile
 
 GFF_EXT = 'gff'
 SCIDX_EXT = 'scidx'
 
+# The reads at each index, as loaded by ReadLoader
+READ_DTYPE = numpy.dtype([('index', numpy.int64), ('forward', numpy.int64), ('reverse', numpy.int64)])
+# Bytes of reads ReadLoader keeps in memory before spilling them to disk, and
+# the size of the blocks it reads the file in
+LOADER_MEMORY = 1024 * 1024 * 1024
+LOADER_BLOCK = 4 * 1024 * 1024
+
+# Relative costs of the ways add_normals can add the normals to an array:
+# per read (adding each read's normal in turn), per read per normal position
+# (a shift and add over only the positions with reads), per array position
+# per normal position (a shift and add over a dense vector of counts), and
+# per array position for an FFT. add_normals uses the cheapest one.
+LOOP_COST = 4000
+SPARSE_COST = 15
+DENSE_COST = 1
+FFT_COST = 70
+# The normals are added a block of reads (or array positions) at a time, so
+# the part of the array being updated stays in the CPU cache (FFT_BLOCK is
+# the size of each FFT)
+SPARSE_BLOCK = 4096
+DENSE_BLOCK = 32768
+FFT_BLOCK = 8192
+
 
 def noop(data):
     return data
@@ -40,124 +62,169 @@ def convert_data(data, in_fmt, out_fmt):
     return data
 
 
-class ChromosomeManager(object):
+class ReadLoader(object):
     """
-    Manages a CSV reader of an index file to only load one chrom at a time
+    Loads the reads in a GFF or scidx file into a structured array (of
+    READ_DTYPE) for each chromosome, sorted by index. For GFF, the reads at
+    the same index are summed (by strand). The file is read a block of lines
+    at a time, and once the loaded reads take more than memory bytes, they
+    are spilled to a temporary file. Each chromosome is then loaded back (one
+    at a time) and sorted in memory.
+
+    Chromosomes are returned in name order for GFF (like sort), and in the
+    order they are first seen for scidx.
     """
 
-    def __init__(self, reader):
-        self.done = False
-        self.reader = reader
-        self.processed_chromosomes = []
-        self.current_index = 0
-        self.next_valid()
-
-    def next(self):
-        self.line = self.reader.next()
-
-    def is_valid(self, line):
-        if len(line) not in [4, 5, 9]:
-            return False
-        try:
-            [int(i) for i in line[1:]]
-            self.format = SCIDX_EXT
-            return True
-        except ValueError:
-            try:
-                if len(line) < 6:
-                    return False
-                [int(line[4]), int(line[5])]
-                self.format = GFF_EXT
-                return True
-            except ValueError:
-                return False
-
-    def next_valid(self):
-        """
-        Advance to the next valid line in the reader
+    def __init__(self, path, format, memory=LOADER_MEMORY):
+        self.path = path
+        self.format = format
+        self.memory = memory
+        self.cnames = []
+        self.parts = {}
+        self.loaded = 0
+        self.spill = None
+
+    def __iter__(self):
+        self.load()
+        cnames = self.cnames
+        if self.format == GFF_EXT:
+            cnames = sorted(cnames)
+        for cname in cnames:
+            yield cname, self.chromosome(cname)
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+
+    def load(self):
         """
-        self.line = self.reader.next()
-        s = 0
-        while not self.is_valid(self.line):
-            self.line = self.reader.next()
-            s += 1
-        if s > 0:
-            # Skip initial line(s) of file
-            pass
-
-    def parse_line(self, line):
-        if self.format == SCIDX_EXT:
-            return [int(line[1]), int(line[2]), int(line[3])]
-        else:
-            return [int(line[3]), line[6], line[5]]
-
-    def chromosome_name(self):
+        Reads the file into parts for each chromosome (spilling them to disk
+        as needed)
         """
-        Return the name of the chromosome about to be loaded
+        with open(self.path, 'rU') as infile:
+            while True:
+                lines = infile.readlines(LOADER_BLOCK)
+                if not lines:
+                    break
+                if self.format == GFF_EXT:
+                    block = self.parse_gff(lines)
+                else:
+                    block = self.parse_scidx(lines)
+                for cname, (indexes, forward, reverse) in block:
+                    reads = numpy.empty(len(indexes), READ_DTYPE)
+                    reads['index'] = indexes
+                    reads['forward'] = forward
+                    reads['reverse'] = reverse
+                    if cname not in self.parts:
+                        self.cnames.append(cname)
+                        self.parts[cname] = []
+                    self.parts[cname].append(reads)
+                    self.loaded += reads.nbytes
+                if self.loaded > self.memory:
+                    self.spill_parts()
+
+    def parse_gff(self, lines):
         """
-        return self.line[0]
-
-    def load_chromosome(self, collect_data=True):
-        """
-        Load the current chromosome into an array and return it
+        Returns [(cname, (indexes, forward, reverse))] for the reads in the
+        lines (skipping comments, and other lines without an int start)
         """
-        cname = self.chromosome_name()
-        if cname in self.processed_chromosomes:
-            stop_err('File is not grouped by chromosome')
-        self.data = []
-        while self.line[0] == cname:
-            if collect_data:
-                read = self.parse_line(self.line)
-                if read[0] < self.current_index:
-                    msg = 'Reads in chromosome %s are not sorted by index. (At index %d)' % (cname, self.current_index)
-                    stop_err(msg)
-                self.current_index = read[0]
-                self.add_read(read)
+        block = {}
+        cnames = []
+        cname = None
+        for line in lines:
+            cols = line.split('\t', 7)
+            if len(cols) < 7 or cols[0].startswith('#'):
+                continue
             try:
-                self.next()
-            except StopIteration:
-                self.done = True
-                break
-        self.processed_chromosomes.append(cname)
-        self.current_index = 0
-        data = self.data
-        # Don't retain reference anymore to save memory
-        del self.data
-        return data
-
-    def add_read(self, read):
-        if self.format == SCIDX_EXT:
-            self.data.append(read)
-        else:
-            index, strand, value = read
+                index = int(cols[3])
+            except ValueError:
+                continue
+            value = cols[5]
             if value == '' or value == '.':
                 value = 1
             else:
                 value = int(value)
-            if not self.data:
-                self.data.append([index, 0, 0])
-                current_read = self.data[-1]
-            if self.data[-1][0] == index:
-                current_read = self.data[-1]
-            elif self.data[-1][0] < index:
-                self.data.append([index, 0, 0])
-                current_read = self.data[-1]
-            else:
-                msg = 'Reads in chromosome %s are not sorted by index. (At index %d)' % (self.chromosome_name(), index)
-                stop_err(msg)
+            if cols[0] != cname:
+                cname = cols[0]
+                if cname not in block:
+                    block[cname] = ([], [], [])
+                    cnames.append(cname)
+                indexes, forward, reverse = block[cname]
+            indexes.append(index)
+            strand = cols[6].rstrip('\r\n')
             if strand == '+':
-                current_read[1] += value
+                forward.append(value)
+                reverse.append(0)
             elif strand == '-':
-                current_read[2] += value
+                forward.append(0)
+                reverse.append(value)
             else:
-                msg = 'Strand "%s" at chromosome "%s" index %d is not valid.' % (strand, self.chromosome_name(), index)
+                msg = 'Strand "%s" at chromosome "%s" index %d is not valid.' % (strand, cname, index)
                 stop_err(msg)
+        return [(name, block[name]) for name in cnames]
 
-    def skip_chromosome(self):
+    def parse_scidx(self, lines):
         """
-        Skip the current chromosome, discarding data
+        Returns [(cname, (indexes, forward, reverse))] for the reads in the
+        lines (skipping the header, and other lines without int counts)
         """
-        self.load_chromosome(collect_data=False)
+        block = {}
+        cnames = []
+        cname = None
+        for line in lines:
+            cols = line.split('\t', 4)
+            if len(cols) < 4:
+                continue
+            try:
+                index, forward_count, reverse_count = int(cols[1]), int(cols[2]), int(cols[3])
+            except ValueError:
+                continue
+            if cols[0] != cname:
+                cname = cols[0]
+                if cname not in block:
+                    block[cname] = ([], [], [])
+                    cnames.append(cname)
+                indexes, forward, reverse = block[cname]
+            indexes.append(index)
+            forward.append(forward_count)
+            reverse.append(reverse_count)
+        return [(name, block[name]) for name in cnames]
+
+    def spill_parts(self):
+        """
+        Writes the loaded reads to the spill file, keeping their (offset,
+        count) in parts.
+        """
+        if not self.spill:
+            self.spill = tempfile.TemporaryFile()
+        for parts in self.parts.itervalues():
+            for i, reads in enumerate(parts):
+                if isinstance(reads, numpy.ndarray):
+                    parts[i] = (self.spill.tell(), len(reads))
+                    reads.tofile(self.spill)
+        self.loaded = 0
+
+    def chromosome(self, cname):
+        """
+        Returns the reads in a chromosome, sorted by index (and removes them
+        from the loader)
+        """
+        parts = self.parts.pop(cname)
+        for i, reads in enumerate(parts):
+            if not isinstance(reads, numpy.ndarray):
+                offset, count = reads
+                self.spill.seek(offset)
+                parts[i] = numpy.fromfile(self.spill, READ_DTYPE, count)
+        reads = numpy.concatenate(parts)
+        del parts[:]
+        reads = reads[numpy.argsort(reads['index'], kind='mergesort')]
+        if self.format == GFF_EXT:
+            # Sum the reads at each index
+            starts = numpy.flatnonzero(numpy.r_[True, reads['index'][1:] != reads['index'][:-1]])
+            summed = reads[starts]
+            summed['forward'] = numpy.add.reduceat(reads['forward'], starts)
+            summed['reverse'] = numpy.add.reduceat(reads['reverse'], starts)
+            reads = summed
+        return reads
 
 
 class Peak(object):
@@ -173,6 +240,14 @@ class Peak(object):
         return '[%d] %d' % (self.index, self.value)
 
 
+class RowList(list):
+    """
+    A list of rows, that can be used in place of a CSV writer
+    """
+    writerow = list.append
+    writerows = list.extend
+
+
 def gff_row(cname, start, end, score, source, type='.', strand='.', phase='.', attrs={}):
     return (cname, source, type, start, end, score, strand, phase, gff_attrs(attrs))
 
@@ -220,7 +295,20 @@ def get_index(value, keys):
     return bisect.bisect_left(keys, value)
 
 
+def read_array(data):
+    """
+    Returns the reads as an (n, 3) int64 array of index, forward, reverse
+    (from a list of [index, forward, reverse], or an array of READ_DTYPE)
+    """
+    if isinstance(data, numpy.ndarray) and data.dtype == READ_DTYPE:
+        return numpy.ascontiguousarray(data).view(numpy.int64).reshape(-1, 3)
+    return numpy.asarray(data, numpy.int64).reshape(-1, 3)
+
+
 def get_range(data):
+    if isinstance(data, numpy.ndarray):
+        indexes = read_array(data)[:, 0]
+        return int(indexes.min()), int(indexes.max())
     lo = min([item[0] for item in data])
     hi = max([item[0] for item in data])
     return lo, hi
@@ -278,6 +366,98 @@ def normal_array(width, sigma, normalize=True):
     return values
 
 
+def add_normals(array, starts, counts, normal):
+    """
+    Adds normal * count to array[start:start + len(normal)] for each read
+    (starts and counts are numpy arrays, with starts sorted).
+
+    Unless the FFT is used, each value in the array is summed in the same
+    order as adding each read's normal in turn, so the result is identical:
+    the shift and add convolutions add the normal one position at a time,
+    from the last position to the first, a block of reads at a time. The FFT
+    convolution (for long normals over dense reads) is equal within rounding
+    error, so it can drop or add peaks that depend on last-bit ties (see
+    add_normals_fft).
+    """
+    keep = counts != 0
+    starts = starts[keep]
+    counts = counts[keep].astype(numpy.float)
+    if not len(starts):
+        return
+    size = len(normal)
+    length = len(array) - size + 1
+    loop_cost = len(starts) * LOOP_COST
+    sparse_cost = len(starts) * size * SPARSE_COST
+    dense_cost = length * size * DENSE_COST
+    fft_cost = len(array) * FFT_COST
+    cost = min(loop_cost, sparse_cost, dense_cost, fft_cost)
+    if cost == loop_cost:
+        for start, count in zip(starts.tolist(), counts.tolist()):
+            array[start:start + size] += normal * count
+    elif cost == sparse_cost:
+        for first in xrange(0, len(starts), SPARSE_BLOCK):
+            layers = split_layers(starts[first:first + SPARSE_BLOCK], counts[first:first + SPARSE_BLOCK])
+            for i in xrange(size - 1, -1, -1):
+                for layer_starts, layer_counts in layers:
+                    array[layer_starts + i] += layer_counts * normal[i]
+    elif cost == dense_cost:
+        dense = [numpy.bincount(layer_starts, weights=layer_counts, minlength=length) for layer_starts, layer_counts in split_layers(starts, counts)]
+        scaled = numpy.empty(DENSE_BLOCK, numpy.float)
+        for first in xrange(0, length, DENSE_BLOCK):
+            last = min(first + DENSE_BLOCK, length)
+            block = scaled[:last - first]
+            for i in xrange(size - 1, -1, -1):
+                for layer_counts in dense:
+                    numpy.multiply(layer_counts[first:last], normal[i], block)
+                    array[first + i:last + i] += block
+    else:
+        add_normals_fft(array, numpy.bincount(starts, weights=counts, minlength=length), normal)
+
+
+def split_layers(starts, counts):
+    """
+    Splits reads into layers with at most one read at each start (the first
+    read at each start, then the second...), so reads with the same start can
+    be added in turn, in order.
+    """
+    same = numpy.arange(len(starts)) - numpy.searchsorted(starts, starts)
+    return [(starts[same == i], counts[same == i]) for i in xrange(same.max() + 1)]
+
+
+def add_normals_fft(array, dense, normal):
+    """
+    Adds the convolution of dense (the count at each start) and normal to the
+    array, with an FFT (overlap-add, with all of the blocks in one 2D FFT).
+    The result is rounded to 2^-40 of its largest value, so the FFT's rounding
+    noise doesn't break ties between equal values (or call peaks where there
+    are no reads).
+
+    The values are only equal within rounding error, so peaks that depend on
+    a tie in the last bits can still be dropped or added: the rounding turns
+    values that the per read sums make slightly different into a tie (or the
+    other way round).
+    """
+    size = len(normal)
+    fft_size = max(FFT_BLOCK, 1 << (2 * size).bit_length())
+    block = fft_size - size + 1
+    blocks = -(-len(dense) // block)
+    rows = numpy.zeros((blocks, block), numpy.float)
+    rows.ravel()[:len(dense)] = dense
+    rows = numpy.fft.irfft(numpy.fft.rfft(rows, fft_size, axis=1) * numpy.fft.rfft(normal, fft_size), fft_size, axis=1)
+    # Each block's convolution overlaps the start of the next block's
+    summed = numpy.zeros((blocks + 1) * block, numpy.float)
+    summed[:blocks * block] = rows[:, :block].ravel()
+    tails = numpy.zeros((blocks, block), numpy.float)
+    tails[:, :size - 1] = rows[:, block:]
+    summed[block:] += tails.ravel()
+    summed = summed[:len(array)]
+
+    quantum = math.ldexp(1.0, math.frexp(summed.max())[1] - 40)
+    numpy.round(summed / quantum, out=summed)
+    summed *= quantum
+    array += summed
+
+
 def call_peaks(array, shift, data, keys, direction, down_width, up_width, exclusion):
     peaks = []
 
@@ -296,32 +476,51 @@ def call_peaks(array, shift, data, keys, direction, down_width, up_width, exclus
     find_peaks()
 
     def calculate_reads():
-        # Calculate the number of reads in each peak
-        for peak in peaks:
-            reads = get_window(data, peak.start, peak.end, keys)
-            peak.value = sum([read[direction] for read in reads])
-            # Flat list of indexes with frequency
-            indexes = [r for read in reads for r in [read[0]] * read[direction]]
-            peak.stddev = numpy.std(indexes)
+        # Calculate the number of reads in each peak, and the stddev of their
+        # indexes, from cumulative sums of the counts, counts * index and
+        # counts * index^2. The sums are uint64, which wraps around, but the
+        # sums for each peak (centered on the peak) are small, so are exact.
+        if not peaks:
+            return
+        indexes = data[:, 0].astype(numpy.uint64)
+        counts = data[:, direction].astype(numpy.uint64)
+        sums = numpy.zeros((3, len(data) + 1), numpy.uint64)
+        numpy.cumsum(counts, out=sums[0, 1:])
+        numpy.cumsum(counts * indexes, out=sums[1, 1:])
+        numpy.cumsum(counts * indexes * indexes, out=sums[2, 1:])
+        starts = numpy.searchsorted(keys, [peak.start for peak in peaks], 'left')
+        ends = numpy.searchsorted(keys, [peak.end for peak in peaks], 'right')
+        count, count_index, count_index2 = sums[:, ends] - sums[:, starts]
+        centers = numpy.array([peak.index for peak in peaks], numpy.int64).astype(numpy.uint64)
+        offset = count_index - centers * count
+        offset2 = count_index2 - centers * (count_index + offset)
+        count, offset, offset2 = count.view(numpy.int64), offset.view(numpy.int64), offset2.view(numpy.int64)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            stddevs = numpy.sqrt((count * offset2 - offset * offset) / numpy.square(count.astype(numpy.float)))
+        for peak, value, stddev in zip(peaks, count.tolist(), stddevs):
+            peak.value = value
+            peak.stddev = stddev
     calculate_reads()
 
     def perform_exclusion():
-        # Process the exclusion zone
-        peak_keys = make_peak_keys(peaks)
-        peaks_by_value = peaks[:]
-        peaks_by_value.sort(key=lambda peak: -peak.value)
-        for peak in peaks_by_value:
-            peak.safe = True
-            window = get_window(peaks,
-                                peak.index - exclusion // 2,
-                                peak.index + exclusion // 2,
-                                peak_keys)
-            for excluded in window:
-                if excluded.safe:
-                    continue
-                i = get_index(excluded.index, peak_keys)
-                del peak_keys[i]
-                del peaks[i]
+        # Process the exclusion zone: a peak is excluded if a peak before it
+        # (by value, then index) is within exclusion // 2 of it, even if that
+        # peak is excluded itself. This is a sweep over the peaks in index
+        # order, comparing each peak to the next peak, the one after that...
+        if not peaks:
+            return
+        half = exclusion // 2
+        indexes = numpy.array(make_peak_keys(peaks), numpy.int64)
+        order = numpy.argsort(-numpy.array([peak.value for peak in peaks]), kind='mergesort')
+        rank = numpy.empty(len(peaks), numpy.int64)
+        rank[order] = numpy.arange(len(peaks))
+        excluded = numpy.zeros(len(peaks), numpy.bool)
+        reach = numpy.searchsorted(indexes, indexes + half, 'right') - numpy.arange(len(peaks)) - 1
+        for i in xrange(1, reach.max() + 1):
+            near = indexes[i:] - indexes[:-i] <= half
+            excluded[i:] |= near & (rank[:-i] < rank[i:])
+            excluded[:-i] |= near & (rank[i:] < rank[:-i])
+        peaks[:] = [peak for peak, peak_excluded in zip(peaks, excluded.tolist()) if not peak_excluded]
     perform_exclusion()
     return peaks
 
@@ -332,26 +531,22 @@ def process_chromosome(cname, data, writer, process_bounds, width, sigma, down_w
     writer to write processes results to, the bounds (2-tuple) to write
     results in, and options.
     """
-    if not data:
+    if not len(data):
         return
-    keys = make_keys(data)
+    reads = read_array(data)
+    keys = reads[:, 0]
     # Create the arrays that hold the sum of the normals
-    forward_array, forward_shift = allocate_array(data, width)
-    reverse_array, reverse_shift = allocate_array(data, width)
+    forward_array, forward_shift = allocate_array(reads, width)
+    reverse_array, reverse_shift = allocate_array(reads, width)
     normal = normal_array(width, sigma)
 
     def populate_array():
         # Add each read's normal to the array
-        for read in data:
-            index, forward, reverse = read
-            # Add the normals to the appropriate regions
-            if forward:
-                forward_array[index + forward_shift - width:index + forward_shift + width] += normal * forward
-            if reverse:
-                reverse_array[index + reverse_shift - width:index + reverse_shift + width] += normal * reverse
+        add_normals(forward_array, keys + (forward_shift - width), reads[:, 1], normal)
+        add_normals(reverse_array, keys + (reverse_shift - width), reads[:, 2], normal)
     populate_array()
-    forward_peaks = call_peaks(forward_array, forward_shift, data, keys, 1, down_width, up_width, exclusion)
-    reverse_peaks = call_peaks(reverse_array, reverse_shift, data, keys, 2, down_width, up_width, exclusion)
+    forward_peaks = call_peaks(forward_array, forward_shift, reads, keys, 1, down_width, up_width, exclusion)
+    reverse_peaks = call_peaks(reverse_array, reverse_shift, reads, keys, 2, down_width, up_width, exclusion)
     # Convert chromosome name in preparation for writing output
     cname = convert_data(cname, 'zeropad', 'numeric')
 
@@ -376,15 +571,3 @@ def process_chromosome(cname, data, writer, process_bounds, width, sigma, down_w
     for peak in reverse_peaks:
         if process_bounds[0] < peak.index < process_bounds[1]:
             write(cname, '-', peak)
-
-
-def sort_chromosome_reads_by_index(input_path):
-    """
-    Return a gff file with chromosome reads sorted by index.
-    """
-    # Will this sort produce different results across platforms?
-    output_path = tempfile.NamedTemporaryFile(delete=False).name
-    command = 'sort -k 1,1 -k 4,4n "%s" > "%s"' % (input_path, output_path)
-    p = subprocess.Popen(command, shell=True)
-    p.wait()
-    return output_path
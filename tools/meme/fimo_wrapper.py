@@ -9,7 +9,7 @@ import tempfile
 
 BUFFSIZE = 1048576
 # Translation table for reverse Complement, with ambiguity codes.
-DNA_COMPLEMENT = string.maketrans("ACGTRYKMBDHVacgtrykmbdhv", "TGCAYRMKVHDBtgcayrmkvhdb")
+DNA_COMPLEMENT = string.maketrans("ACGTUMRWSYKVHDBNacgtumrwsykvhdbn", "TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn")
 
 
 def get_stderr(tmp_stderr):
@@ -37,8 +37,7 @@ def dna_complement(sequence):
 
 def dna_reverse_complement(sequence):
     # Returns the reverse complement of the sequence.
-    sequence = reverse(sequence)
-    return dna_complement(sequence)
+    return reverse(dna_complement(sequence))
 
 
 def stop_err(msg):
@@ -63,16 +63,21 @@ Currently, the available filters are:
 
 
     -exclude ref:start-end     Remove reads in this region (1-based start)
-    -excludebed file.bed {nostrand}
+    -excludebed file.bed {nostrand} {stream}
                                Remove reads that are in any of the regions
                                from the given BED file. If 'nostrand' is given,
                                strand information from the BED file is ignored.
+                               If 'stream' is given, the BED file is read
+                               along with the reads, instead of being loaded
+                               into memory. Both the BAM and BED files must be
+                               sorted (with chromosomes in the same order).
 
     -include ref:start-end     Remove reads NOT in the region (can only be one)
-    -includebed file.bed {nostrand}
+    -includebed file.bed {nostrand} {stream}
                                Remove reads that are NOT any of the regions
                                from the given BED file. If 'nostrand' is given,
                                strand information from the BED file is ignored.
+                               (See -excludebed for 'stream')
 
                                Note: If this is a large dataset, use
                                "bamutils extract" instead.
@@ -108,24 +113,56 @@ Common tags to filter by:
 
 """
 
+import hashlib
+import heapq
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
+import time
 
 import pysam
-from ngsutils.bam import bam_iter, read_calc_mismatches, read_calc_mismatches_gen, read_calc_mismatches_ref, read_calc_variations
-from ngsutils.bed import BedFile
+from ngsutils.bam import RefWindowCache, bam_iter, read_calc_mismatches, read_calc_mismatches_gen, read_calc_mismatches_ref, read_calc_variations, read_tag, set_read_tags
+from ngsutils.bed import BedFile, BedStreamer, BedSweep
 from ngsutils.support.dbsnp import DBSNP
 
 
 def usage():
     print __doc__
     print """
-Usage: bamutils filter in.bam out.bam {-failed out.txt} criteria...
+Usage: bamutils filter in.bam out.bam {-failed out.txt} {-failedbam out.bam} {-threads N} criteria...
 
 Options:
   -failed fname    A text file containing the read names of all reads
                    that were removed with filtering
 
+  -failedbam fname A BAM file containing all of the reads that were removed
+                   with filtering. Each read is tagged with the criterion
+                   that removed it (XF:Z). This is written in the same pass
+                   as out.bam.
+
+  -threads N       Filter the BAM file in N parallel processes. The input
+                   must be coordinate sorted and indexed (in.bam.bai). Each
+                   process filters a set of reference regions, and the
+                   results are merged back in the original read order.
+                   (If there is no index, the file is filtered serially)
+
+  -v               Verbose output. Also writes the number of reads evaluated
+                   and rejected by each criterion, and the estimated time
+                   spent in each one. For the dbSNP and reference criteria,
+                   the number of dbSNP/reference lookups that were found
+                   in the cached window (hits) or needed a new query
+                   (misses) is also written.
+
+Criteria that only check the read flag are combined into a single check.
+The flag, tag, reference, region, BED, and white/blacklist criteria are
+re-ordered while filtering, so that the ones that are cheap and remove the
+most reads run first (the flag check is always run first). The other criteria
+are always run in the order given, as they keep state between reads (-uniq,
+-uniq_start, -include, dbSNP) or can't handle every read (-minlen on a read
+with no sequence, or -mismatch on a read with no NM tag).
+
 Example:
 bamutils filter filename.bam output.bam -mapped -gte AS:i 1000
 
@@ -136,6 +173,11 @@ value less than 1000.
 
 
 class Unique(object):
+    '''
+    Reads are only compared to other reads that start at the same position,
+    so only the (md5) digests of the sequences at the current position are
+    kept. peak is the largest number of sequences seen at one position.
+    '''
     def __init__(self, length=None):
         if length:
             self.length = int(length)
@@ -144,6 +186,7 @@ class Unique(object):
 
         self.last_pos = None
         self.pos_reads = set()
+        self.peak = 0
 
     def __repr__(self):
         return "uniq"
@@ -151,31 +194,47 @@ class Unique(object):
     def filter(self, bam, read):
         if self.last_pos != (read.tid, read.pos):
             self.last_pos = (read.tid, read.pos)
-            self.pos_reads = set()
+            self.pos_reads.clear()
 
+        # secondary/supplementary reads may have no sequence (SEQ '*')
+        seq = read.seq or ''
         if read.is_reverse:
-            seq = read.seq[::-1]  # ignore revcomp for now, it isn't needed, just need to compare in the proper order
-        else:
-            seq = read.seq
+            seq = seq[::-1]  # ignore revcomp for now, it isn't needed, just need to compare in the proper order
 
         if self.length:
             seq = seq[:self.length]
 
-        if seq in self.pos_reads:
+        digest = hashlib.md5(seq).digest()
+        if digest in self.pos_reads:
             return False
 
-        self.pos_reads.add(seq)
+        self.pos_reads.add(digest)
+        if len(self.pos_reads) > self.peak:
+            self.peak = len(self.pos_reads)
         return True
 
+    def counters(self):
+        return {'peak': self.peak}
+
     def close(self):
         pass
 
 
 class UniqueStart(object):
+    '''
+    Forward reads are compared by their start position, reverse reads by their
+    end position (aend). Reverse reads aren't sorted by aend, so the aend
+    values are kept in a set. Because reads are sorted by pos, an aend that
+    is less than the current pos can't be seen again, so aend values are
+    also kept in a heap and removed from the set once the reads move past
+    them. peak is the largest size of the set.
+    '''
     def __init__(self):
         self.last_tid = None
         self.last_fwd_pos = -1
-        self.rev_pos_list = None
+        self.rev_pos = set()
+        self.rev_heap = []
+        self.peak = 0
 
     def __repr__(self):
         return "uniq_start"
@@ -184,31 +243,24 @@ class UniqueStart(object):
         if self.last_tid is None or self.last_tid != read.tid:
             self.last_tid = read.tid
             self.rev_pos = set()
+            self.rev_heap = []
             self.last_fwd_pos = -1
-            self.last_rev_pos = -1
 
         if read.is_reverse:
             # check reverse reads from their start (3' aend)
             # these aren't necessarily in the correct
             # order in the file, so we have to track them in a set
 
-            start_pos = read.aend
-
-            # clean up hash if necesary
-            # Allow up to 100k over, to balance cleaning up the rev_pos hash
-            # and memory
-            if read.pos > (self.last_rev_pos + 100000):
-                self.last_rev_pos = start_pos
-                del_list = []
-                for k in self.rev_pos:
-                    if k < read.pos:
-                        del_list.append(k)
+            while self.rev_heap and self.rev_heap[0] < read.pos:
+                self.rev_pos.remove(heapq.heappop(self.rev_heap))
 
-                for k in del_list:
-                    self.rev_pos.remove(k)
+            start_pos = read.aend
 
             if start_pos not in self.rev_pos:
                 self.rev_pos.add(start_pos)
+                heapq.heappush(self.rev_heap, start_pos)
+                if len(self.rev_pos) > self.peak:
+                    self.peak = len(self.rev_pos)
                 return True
             return False
         else:
@@ -217,10 +269,8 @@ class UniqueStart(object):
                 return True
             return False
 
-        # if self.last_pos != (read.tid, read.pos):
-        #     self.last_pos = (read.tid, read.pos)
-        #     return True
-        # return False
+    def counters(self):
+        return {'peak': self.peak}
 
     def close(self):
         pass
@@ -290,14 +340,14 @@ class IncludeRegion(object):
 
 
 class IncludeBED(object):
-    def __init__(self, fname, nostrand=None):
-        self.excl = ExcludeBED(fname, nostrand)
+    def __init__(self, fname, nostrand=None, stream=None):
+        self.excl = ExcludeBED(fname, nostrand, stream)
 
     def filter(self, bam, read):
         return not self.excl.filter(bam, read)
 
     def __repr__(self):
-        return 'Including from BED: %s%s' % (self.excl.fname, ' nostrand' if self.excl.nostrand else '')
+        return 'Including from BED: %s%s%s' % (self.excl.fname, ' nostrand' if self.excl.nostrand else '', ' stream' if self.excl.stream else '')
 
     def close(self):
         pass
@@ -363,15 +413,21 @@ class IncludeRef(object):
 
 
 class ExcludeBED(object):
-    def __init__(self, fname, nostrand=None):
+    def __init__(self, fname, nostrand=None, stream=None):
         self.regions = {}  # store BED regions as keyed bins (chrom, bin)
         self.fname = fname
-        if nostrand == 'nostrand':
+        if 'nostrand' in [nostrand, stream]:
             self.nostrand = True
         else:
             self.nostrand = False
 
-        self.bed = BedFile(fname)
+        if 'stream' in [nostrand, stream]:
+            # the BED file is streamed along with the reads (see BedSweep)
+            self.stream = True
+            self.bed = None
+        else:
+            self.stream = False
+            self.bed = BedFile(fname)
         # with open(fname) as f:
         #     for line in f:
         #         if not line:
@@ -405,6 +461,9 @@ class ExcludeBED(object):
             else:
                 strand = '+'
 
+            if self.stream and self.bed is None:
+                self.bed = BedSweep(BedStreamer(self.fname, quiet=True), bam.references)
+
             for region in self.bed.fetch(bam.getrname(read.tid), read.pos, read.aend, strand):
                 # region found, exclude read
                 return False
@@ -429,7 +488,7 @@ class ExcludeBED(object):
         # return True
 
     def __repr__(self):
-        return 'Excluding from BED: %s%s' % (self.fname, ' nostrand' if self.nostrand else '')
+        return 'Excluding from BED: %s%s%s' % (self.fname, ' nostrand' if self.nostrand else '', ' stream' if self.stream else '')
 
     def close(self):
         pass
@@ -463,7 +522,7 @@ class MismatchRef(object):
         if not os.path.exists('%s.fai' % refname):
             pysam.faidx(refname)
 
-        self.ref = pysam.Fastafile(refname)
+        self.ref = RefWindowCache(pysam.Fastafile(refname))
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -478,6 +537,9 @@ class MismatchRef(object):
     def __repr__(self):
         return '>%s mismatch%s in %s' % (self.num, '' if self.num == 1 else 'es', os.path.basename(self.refname))
 
+    def counters(self):
+        return {'ref_hits': self.ref.hits, 'ref_misses': self.ref.misses}
+
     def close(self):
         self.ref.close()
 
@@ -516,13 +578,17 @@ class MismatchDbSNP(object):
             return False
 
         if snps:
-            read.tags = read.tags + [('ZS', snps)]
+            set_read_tags(read, read.tags + [('ZS', snps)])
 
         return True
 
     def __repr__(self):
         return '>%s mismatch%s using %s' % (self.num, '' if self.num == 1 else 'es', os.path.basename(self.fname))
 
+    def counters(self):
+        info = self.dbsnp.cache_info()
+        return {'dbsnp_hits': info.hits, 'dbsnp_misses': info.misses}
+
     def close(self):
         self.dbsnp.close()
 
@@ -532,12 +598,13 @@ class MismatchRefDbSNP(object):
         sys.stderr.write('Note: MismatchRefDbSNP is considered *experimental*\n')
         self.num = int(num)
         self.refname = refname
+        self.dbsnpname = dbsnpname
         self.dbsnp = DBSNP(dbsnpname)
 
         if not os.path.exists('%s.fai' % refname):
             pysam.faidx(refname)
 
-        self.ref = pysam.Fastafile(refname)
+        self.ref = RefWindowCache(pysam.Fastafile(refname))
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -558,13 +625,17 @@ class MismatchRefDbSNP(object):
             return False
 
         if snps:
-            read.tags = read.tags + [('ZS', snps)]
+            set_read_tags(read, read.tags + [('ZS', snps)])
 
         return True
 
     def __repr__(self):
         return '>%s mismatch%s using %s/%s' % (self.num, '' if self.num == 1 else 'es', os.path.basename(self.dbsnpname), os.path.basename(self.refname))
 
+    def counters(self):
+        info = self.dbsnp.cache_info()
+        return {'dbsnp_hits': info.hits, 'dbsnp_misses': info.misses, 'ref_hits': self.ref.hits, 'ref_misses': self.ref.misses}
+
     def close(self):
         self.ref.close()
         self.dbsnp.close()
@@ -770,11 +841,8 @@ class _TagCompare(object):
         if self.tag == 'MAPQ':
             return read.mapq
 
-        for name, value in read.tags:
-            if name == self.tag:
-                return value
-
-        return None
+        # the tags are decoded once per read, and shared by all tag criteria
+        return read_tag(read, self.tag)
 
     def __repr__(self):
         return "%s %s %s" % (self.tag, self.__class__.op, self.value)
@@ -857,16 +925,243 @@ _criteria = {
     'minlen': ReadMinLength,
     'maxlen': ReadMaxLength,
     'uniq': Unique,
+    'uniq_start': UniqueStart,
     'maximum_mismatch_ratio': MaximumMismatchRatio
 }
 
 
-def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
+# Criteria that only look at the read's flag. These are fused into a single
+# lookup table indexed by the flag value.
+_flag_criteria = (Mapped, Unmapped, ProperPair, NoProperPair, MaskFlag, SecondaryFlag, QCFailFlag, PCRDupFlag)
+
+# Criteria that can be moved: they don't keep state between reads, and they
+# handle every read. The others are never moved, and other criteria aren't
+# moved across them, because their results depend on which reads they see
+# (uniq, dbSNP), or because they raise on some reads that an earlier criterion
+# may have removed (-minlen on a secondary read with no sequence, -mismatch on
+# a read with no NM tag).
+_reorderable_criteria = _flag_criteria + (Blacklist, Whitelist, ExcludeRegion, ExcludeRef, IncludeRef, ExcludeBED, IncludeBED, _TagCompare)
+
+
+class _Stage(object):
+    '''
+    One step of a CriteriaPipeline: either a single criterion, or a fused set
+    of flag criteria.
+    '''
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.evaluated = 0
+        self.rejected = 0
+        self.timed = 0
+        self.seconds = 0.0
+
+        if len(criteria) == 1 and not isinstance(criteria[0], _flag_criteria):
+            self.filter = criteria[0].filter
+        else:
+            # evaluate the flag criteria for every possible flag value
+            read = pysam.AlignedRead()
+            table = []
+            for flag in xrange(4096):
+                read.flag = flag
+                table.append(all([criterion.filter(None, read) for criterion in criteria]))
+            self.table = tuple(table)
+
+    def filter(self, bam, read):
+        return self.table[read.flag & 0xFFF]
+
+    def rejected_by(self, bam, read):
+        if len(self.criteria) == 1:
+            return self.criteria[0]
+        for criterion in self.criteria:
+            if not criterion.filter(bam, read):
+                return criterion
+
+    @property
+    def cost(self):
+        '''
+        Expected time spent per rejected read. Cheap stages that reject a lot
+        of reads should be run first.
+        '''
+        if not self.rejected:
+            return float('inf')
+        if not self.timed:
+            return 0.0
+        return (self.seconds / self.timed) / (float(self.rejected) / self.evaluated)
+
+    @property
+    def counters(self):
+        '''
+        Extra counters kept by the criterion, such as the peak size of the
+        tracking set (uniq, uniq_start) or dbSNP cache hits/misses
+        '''
+        if len(self.criteria) == 1 and hasattr(self.criteria[0], 'counters'):
+            return self.criteria[0].counters()
+        return {}
+
+    def __repr__(self):
+        return ' & '.join([str(criterion) for criterion in self.criteria])
+
+
+class CriteriaPipeline(object):
+    '''
+    Compiles a list of criteria for bam_filter.
+
+    Flag criteria are fused into one table lookup, and the criteria are
+    periodically reordered so that the ones with the lowest cost per rejected
+    read are run first. Criteria that can't be moved (see
+    _reorderable_criteria) split the pipeline into segments, and criteria are
+    only reordered within a segment. The flag lookup is always run first in
+    its segment.
+
+    filter() returns the criterion that rejected a read, or None if the read
+    passed. Use first_rejection() to find the criterion that would have
+    rejected the read first in command-line order.
+
+    Reordering doesn't change which reads are kept:
+
+    >>> reads = [pysam.AlignedRead() for i in xrange(25001)]
+    >>> for i, read in enumerate(reads[:-1]):
+    ...     read.seq = 'ACGTA' if i % 2 else 'ACGTACGTAC'
+    >>> reads[-1].flag = 0x100  # a secondary read, with no sequence
+    >>> pipeline = CriteriaPipeline([SecondaryFlag(), ReadMinLength(10)])
+    >>> [pipeline.filter(None, read) for read in reads].count(None)
+    12500
+    '''
+
+    _reorder_interval = 10000
+    _timing_mask = 0x3F  # time one of every 64 reads
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.stages = []
+        self._segments = []
+        self._segment_of = {}
+        self._count = 0
+
+        segment = []
+        for criterion in criteria:
+            if not isinstance(criterion, _reorderable_criteria):
+                if segment:
+                    self._segments.append(segment)
+                self._segments.append([criterion])
+                segment = []
+            else:
+                segment.append(criterion)
+        if segment:
+            self._segments.append(segment)
+
+        self._stage_segments = []
+        for segment in self._segments:
+            flags = [criterion for criterion in segment if isinstance(criterion, _flag_criteria)]
+            fixed = []
+            if flags:
+                fixed.append(_Stage(flags))
+            stages = []
+            for criterion in segment:
+                self._segment_of[id(criterion)] = segment
+                if criterion not in flags:
+                    stages.append(_Stage([criterion]))
+            self._stage_segments.append((fixed, stages))
+            self.stages.extend(fixed + stages)
+
+        self._order = self.stages[:]
+
+    def filter(self, bam, read):
+        self._count += 1
+        if self._count % CriteriaPipeline._reorder_interval == 0:
+            self.reorder()
+
+        if self._count & CriteriaPipeline._timing_mask:
+            for stage in self._order:
+                stage.evaluated += 1
+                if not stage.filter(bam, read):
+                    stage.rejected += 1
+                    return stage.rejected_by(bam, read)
+        else:
+            for stage in self._order:
+                stage.evaluated += 1
+                stage.timed += 1
+                start = time.time()
+                passed = stage.filter(bam, read)
+                stage.seconds += time.time() - start
+                if not passed:
+                    stage.rejected += 1
+                    return stage.rejected_by(bam, read)
+
+        return None
+
+    def first_rejection(self, bam, read, criterion):
+        '''
+        Given the criterion that rejected a read, return the first criterion
+        (in command-line order) that rejects it. Only criteria in the same
+        segment could have been skipped, and they are all stateless.
+        '''
+        for other in self._segment_of[id(criterion)]:
+            if other is criterion or not other.filter(bam, read):
+                return other
+        return criterion
+
+    def reorder(self):
+        order = []
+        for fixed, stages in self._stage_segments:
+            order.extend(fixed)
+            order.extend(sorted(stages, key=lambda stage: stage.cost))
+        self._order = order
+
+    def stats(self):
+        '''
+        Returns a list of (stage, evaluated, rejected, est. seconds, counters),
+        in the original order of the stages
+        '''
+        out = []
+        for stage in self.stages:
+            if stage.timed:
+                seconds = stage.seconds * stage.evaluated / stage.timed
+            else:
+                seconds = 0.0
+            out.append((str(stage), stage.evaluated, stage.rejected, seconds, stage.counters))
+        return out
+
+
+def merge_pipeline_stats(stats, other):
+    '''
+    Adds together the stats from two pipelines (peak counters use the max)
+    '''
+    out = []
+    for (name, evaluated, rejected, seconds, counters), (_, evaluated2, rejected2, seconds2, counters2) in zip(stats, other):
+        merged = dict(counters)
+        for key, val in counters2.iteritems():
+            if key not in merged:
+                merged[key] = val
+            elif key == 'peak':
+                merged[key] = max(merged[key], val)
+            else:
+                merged[key] += val
+        out.append((name, evaluated + evaluated2, rejected + rejected2, seconds + seconds2, merged))
+    return out
+
+
+def write_pipeline_stats(stats, out=sys.stderr):
+    out.write('Criteria stats:\n')
+    out.write('    %-40s\t%s\t%s\t%s\t%s\n' % ('criteria', 'evaluated', 'rejected', 'est. time (s)', 'counters'))
+    for name, evaluated, rejected, seconds, counters in stats:
+        extra = ['%s=%s' % (key, counters[key]) for key in sorted(counters)]
+        for cache in ['dbsnp', 'ref']:
+            if '%s_hits' % cache in counters:
+                lookups = counters['%s_hits' % cache] + counters['%s_misses' % cache]
+                if lookups:
+                    extra.append('%s_hit_ratio=%.3f' % (cache, float(counters['%s_hits' % cache]) / lookups))
+        out.write('    %-40s\t%s\t%s\t%.3f\t%s\n' % (name, evaluated, rejected, seconds, ' '.join(extra)))
+
+
+def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False, failedbam=None):
     if verbose:
         sys.stderr.write('Input file  : %s\n' % infile)
         sys.stderr.write('Output file : %s\n' % outfile)
         if failedfile:
             sys.stderr.write('Failed reads: %s\n' % failedfile)
+        if failedbam:
+            sys.stderr.write('Failed BAM  : %s\n' % failedbam)
         sys.stderr.write('Criteria:\n')
         for criterion in criteria:
             sys.stderr.write('    %s\n' % criterion)
@@ -881,35 +1176,267 @@ def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
     else:
         failed_out = None
 
-    passed = 0
-    failed = 0
+    if failedbam:
+        failed_bam = pysam.Samfile(failedbam, "wb", template=bamfile)
+    else:
+        failed_bam = None
 
-    def _callback(read):
-        return "%s | %s kept,%s failed" % ('%s:%s' % (bamfile.getrname(read.tid), read.pos) if read.tid > -1 else 'unk', passed, failed)
+    pipeline = CriteriaPipeline(criteria)
+    passed, failed = _filter_reads(bamfile, bam_iter(bamfile, quiet=True), pipeline, outfile, failed_out, failed_bam)
 
-    for read in bam_iter(bamfile, quiet=True):
-        p = True
+    bamfile.close()
+    outfile.close()
+    if failed_out:
+        failed_out.close()
+    if failed_bam:
+        failed_bam.close()
+    sys.stdout.write("%s kept\n%s failed\n" % (passed, failed))
 
-        for criterion in criteria:
-            if not criterion.filter(bamfile, read):
-                p = False
-                failed += 1
-                if failed_out:
-                    failed_out.write('%s\t%s\n' % (read.qname, criterion))
-                # outfile.write(read_to_unmapped(read))
-                break
-        if p:
+    if verbose:
+        write_pipeline_stats(pipeline.stats())
+
+    for criterion in criteria:
+        criterion.close()
+
+
+def _filter_reads(bamfile, reads, pipeline, outfile, failed_out=None, failed_bam=None):
+    '''
+    Filters reads into outfile. Rejected reads are written to failed_out
+    (read name and criterion) and/or failed_bam (tagged with XF:Z:criterion).
+    '''
+    passed = 0
+    failed = 0
+
+    for read in reads:
+        criterion = pipeline.filter(bamfile, read)
+        if criterion:
+            failed += 1
+            if failed_out or failed_bam:
+                criterion = pipeline.first_rejection(bamfile, read, criterion)
+            if failed_out:
+                failed_out.write('%s\t%s\n' % (read.qname, criterion))
+            if failed_bam:
+                read.tags = [tag for tag in read.tags if tag[0] != 'XF'] + [('XF', str(criterion))]
+                failed_bam.write(read)
+            # outfile.write(read_to_unmapped(read))
+        else:
             passed += 1
             outfile.write(read)
 
+    return passed, failed
+
+
+_shard_size = 10000000
+_shard_state = {}
+
+
+def bam_filter_sharded(infile, outfile, criteria_args, threads, failedfile=None, verbose=False, failedbam=None):
+    '''
+    Filters an indexed BAM file using a pool of worker processes.
+
+    The references are split into shards (see _bam_shards) and each shard is
+    filtered into a temporary BAM file. Each worker builds its own criteria
+    from criteria_args, so that file handles (FASTA, tabix, etc) aren't
+    shared between processes. Shards are merged back in order, followed by
+    the unplaced reads at the end of the file, so the output has the same
+    reads in the same order as bam_filter.
+    '''
+    if verbose:
+        sys.stderr.write('Input file  : %s\n' % infile)
+        sys.stderr.write('Output file : %s\n' % outfile)
+        if failedfile:
+            sys.stderr.write('Failed reads: %s\n' % failedfile)
+        if failedbam:
+            sys.stderr.write('Failed BAM  : %s\n' % failedbam)
+        sys.stderr.write('Threads     : %s\n' % threads)
+        sys.stderr.write('Criteria:\n')
+        for crit_args in criteria_args:
+            sys.stderr.write('    %s\n' % ' '.join(crit_args))
+
+        sys.stderr.write('\n')
+
+    bamfile = pysam.Samfile(infile, "rb")
+
+    # uniq_start tracks reverse reads by their 3' end, so a reference
+    # can't be split between shards.
+    whole_refs = '-uniq_start' in [crit_args[0] for crit_args in criteria_args]
+    shards = _bam_shards(bamfile, whole_refs)
+
+    tmpdir = tempfile.mkdtemp(prefix='tmp-bam-filter-')
+    pool = multiprocessing.Pool(threads, _shard_init, (infile, criteria_args))
+
+    outfile = pysam.Samfile(outfile, "wb", template=bamfile)
+
+    if failedfile:
+        failed_out = open(failedfile, 'w')
+    else:
+        failed_out = None
+
+    if failedbam:
+        failed_bam = pysam.Samfile(failedbam, "wb", template=bamfile)
+    else:
+        failed_bam = None
+
+    results = []
+    offset = None
+
+    try:
+        jobs = [(num, regions, None, tmpdir, failed_out is not None, failed_bam is not None) for num, regions in enumerate(shards)]
+        for num, result in enumerate(pool.imap(_filter_shard, jobs)):
+            _merge_shard(tmpdir, num, outfile, failed_out, failed_bam)
+            results.append(result)
+            if result[2] is not None:
+                offset = result[2]
+
+        # unplaced reads are stored after the last placed read
+        num = len(shards)
+        results.append(pool.apply(_filter_shard, ((num, None, offset, tmpdir, failed_out is not None, failed_bam is not None),)))
+        _merge_shard(tmpdir, num, outfile, failed_out, failed_bam)
+
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(tmpdir)
+
     bamfile.close()
     outfile.close()
     if failed_out:
         failed_out.close()
+    if failed_bam:
+        failed_bam.close()
+    passed = sum([result[0] for result in results])
+    failed = sum([result[1] for result in results])
     sys.stdout.write("%s kept\n%s failed\n" % (passed, failed))
 
-    for criterion in criteria:
-        criterion.close()
+    if verbose:
+        stats = results[0][3]
+        for result in results[1:]:
+            stats = merge_pipeline_stats(stats, result[3])
+        write_pipeline_stats(stats)
+
+
+def _bam_shards(bamfile, whole_refs=False, size=_shard_size):
+    '''
+    Splits the references of a BAM file into shards. Each shard is a list of
+    (ref, start, end) regions covering about {size} bases. Large references
+    are split into multiple shards and small references are grouped together.
+    If whole_refs is True, a reference is never split between shards.
+    '''
+    shards = []
+    regions = []
+    shard_len = 0
+
+    for ref, length in zip(bamfile.references, bamfile.lengths):
+        start = 0
+        while start < length:
+            if whole_refs:
+                end = length
+            else:
+                end = min(start + size - shard_len, length)
+
+            regions.append((ref, start, end))
+            shard_len += end - start
+            start = end
+
+            if shard_len >= size:
+                shards.append(regions)
+                regions = []
+                shard_len = 0
+
+    if regions:
+        shards.append(regions)
+
+    return shards
+
+
+def _shard_init(infile, criteria_args):
+    _shard_state['infile'] = infile
+    _shard_state['bam'] = pysam.Samfile(infile, "rb")
+    _shard_state['criteria'] = [_criteria[crit_args[0][1:]](*crit_args[1:]) for crit_args in criteria_args]
+
+
+def _filter_shard(args):
+    '''
+    Filters one shard into a temporary BAM file (worker process).
+
+    If regions is None, this filters the unplaced reads, starting from the
+    virtual offset of the last placed read (or the start of the file).
+
+    Returns (passed, failed, offset, stats) where offset is the virtual offset
+    just past the last read in the shard (or None if there were no reads) and
+    stats are the CriteriaPipeline stats for the shard.
+    '''
+    num, regions, offset, tmpdir, write_failed, write_failed_bam = args
+
+    pipeline = CriteriaPipeline(_shard_state['criteria'])
+    last_offset = [None]
+
+    if regions is None:
+        bamfile = pysam.Samfile(_shard_state['infile'], "rb")
+        if offset is not None:
+            bamfile.seek(offset)
+
+        def _reads():
+            for read in bamfile:
+                if read.tid < 0:
+                    yield read
+    else:
+        bamfile = _shard_state['bam']
+
+        def _reads():
+            for ref, start, end in regions:
+                for read in bamfile.fetch(ref, start, end):
+                    # reads that overlap the start of the region belong to
+                    # the previous region
+                    if read.pos >= start:
+                        last_offset[0] = bamfile.tell()
+                        yield read
+
+    outname = os.path.join(tmpdir, 'shard.%s.bam' % num)
+    outfile = pysam.Samfile(outname, "wb", template=bamfile)
+
+    if write_failed:
+        failed_out = open(os.path.join(tmpdir, 'shard.%s.failed' % num), 'w')
+    else:
+        failed_out = None
+
+    if write_failed_bam:
+        failed_bam = pysam.Samfile(os.path.join(tmpdir, 'shard.%s.failed.bam' % num), "wb", template=bamfile)
+    else:
+        failed_bam = None
+
+    passed, failed = _filter_reads(bamfile, _reads(), pipeline, outfile, failed_out, failed_bam)
+
+    outfile.close()
+    if failed_out:
+        failed_out.close()
+    if failed_bam:
+        failed_bam.close()
+    if regions is None:
+        bamfile.close()
+
+    return passed, failed, last_offset[0], pipeline.stats()
+
+
+def _merge_shard(tmpdir, num, outfile, failed_out=None, failed_bam=None):
+    for name, out in [('shard.%s.bam' % num, outfile), ('shard.%s.failed.bam' % num, failed_bam)]:
+        if out is None:
+            continue
+        shardname = os.path.join(tmpdir, name)
+        shard = pysam.Samfile(shardname, "rb")
+        for read in shard:
+            out.write(read)
+        shard.close()
+        os.unlink(shardname)
+
+    if failed_out:
+        failedname = os.path.join(tmpdir, 'shard.%s.failed' % num)
+        with open(failedname) as f:
+            shutil.copyfileobj(f, failed_out)
+        os.unlink(failedname)
 
 
 def read_to_unmapped(read):
@@ -935,7 +1462,9 @@ if __name__ == '__main__':
     infile = None
     outfile = None
     failed = None
-    criteria = []
+    failedbam = None
+    threads = 1
+    criteria_args = []
 
     crit_args = []
     last = None
@@ -946,9 +1475,15 @@ if __name__ == '__main__':
         if last == '-failed':
             failed = arg
             last = None
+        elif last == '-failedbam':
+            failedbam = arg
+            last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
         elif arg == '-h':
             usage()
-        elif arg == '-failed':
+        elif arg in ['-failed', '-failedbam', '-threads']:
             last = arg
         elif arg == '-v':
             verbose = True
@@ -961,7 +1496,7 @@ if __name__ == '__main__':
                 print "Unknown criterion: %s" % arg
                 fail = True
             if crit_args:
-                criteria.append(_criteria[crit_args[0][1:]](*crit_args[1:]))
+                criteria_args.append(crit_args)
             crit_args = [arg, ]
         elif crit_args:
             crit_args.append(arg)
@@ -970,18 +1505,23 @@ if __name__ == '__main__':
             fail = True
 
     if not fail and crit_args:
-        criteria.append(_criteria[crit_args[0][1:]](*crit_args[1:]))
+        criteria_args.append(crit_args)
 
-    if fail or not infile or not outfile or not criteria:
-        if not infile and not outfile and not criteria:
+    if fail or not infile or not outfile or not criteria_args:
+        if not infile and not outfile and not criteria_args:
             usage()
 
         if not infile:
             print "Missing: input bamfile"
         if not outfile:
             print "Missing: output bamfile"
-        if not criteria:
+        if not criteria_args:
             print "Missing: filtering criteria"
         usage()
+    elif threads > 1 and os.path.exists('%s.bai' % infile):
+        bam_filter_sharded(infile, outfile, criteria_args, threads, failed, verbose, failedbam)
     else:
-        bam_filter(infile, outfile, criteria, failed, verbose)
+        if threads > 1:
+            sys.stderr.write('Note: %s is not indexed, filtering with one thread\n' % infile)
+        criteria = [_criteria[args[0][1:]](*args[1:]) for args in criteria_args]
+        bam_filter(infile, outfile, criteria, failed, verbose, failedbam)
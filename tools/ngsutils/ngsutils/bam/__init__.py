@@ -1,13 +1,16 @@
+import array
 import os
 import re
 import sys
 
 import ngsutils.support
 import pysam
+from ngsutils.support.progress import default_progress
+
 try:
-    from eta import ETA
-except:
-    pass
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def bam_open(fname, mode='r', *args, **kwargs):
@@ -16,30 +19,42 @@ def bam_open(fname, mode='r', *args, **kwargs):
     return pysam.Samfile(fname, '%s' % mode, *args, **kwargs)
 
 
-def bam_pileup_iter(bam, mask=1796, quiet=False, callback=None):
-    if not quiet and bam.filename:
-        eta = ETA(os.stat(bam.filename).st_size)
-    else:
-        eta = None
+def bam_pileup_iter(bam, mask=1796, quiet=False, callback=None, progress=None):
+    '''
+    Iterates over the pileup columns in a BAM file. Progress is shown on the
+    terminal (unless quiet) or reported to {progress}, a
+    ngsutils.support.progress.Progress object.
+    '''
+    if progress is None and not quiet and bam.filename:
+        progress = default_progress(os.stat(bam.filename).st_size)
 
-    for pileup in bam.pileup(mask=mask):
-        pos = bam.tell()
-        bgz_offset = pos >> 16
+    if progress:
+        every = progress.every
+        countdown = every
 
-        if not quiet:
-            if callback:
-                eta.print_status(bgz_offset, extra=callback(pileup))
-            else:
-                eta.print_status(bgz_offset, extra='%s:%s' % (bam.getrname(pileup.tid), pileup.pos))
+    for pileup in bam.pileup(mask=mask):
+        if progress:
+            countdown -= 1
+            if not countdown:
+                countdown = every
+                if callback:
+                    progress.update(every, bam.tell() >> 16, lambda: callback(pileup))
+                else:
+                    progress.update(every, bam.tell() >> 16, lambda: '%s:%s' % (bam.getrname(pileup.tid), pileup.pos))
 
         yield pileup
 
-    if eta:
-        eta.done()
+    if progress:
+        progress.done(every - countdown, bam.tell() >> 16)
 
 
-def bam_iter(bam, quiet=False, show_ref_pos=False, ref=None, start=None, end=None, callback=None):
+def bam_iter(bam, quiet=False, show_ref_pos=False, ref=None, start=None, end=None, callback=None, progress=None):
     '''
+    Iterates over the reads in a BAM file (or a region, if ref is given).
+    Progress is shown on the terminal (unless quiet) or reported to
+    {progress}, a ngsutils.support.progress.Progress object. The file offset
+    and status text are only looked up every {progress.every} reads.
+
     >>> [x.qname for x in bam_iter(bam_open(os.path.join(os.path.dirname(__file__), 't', 'test.bam')), quiet=True)]
     ['A', 'B', 'E', 'C', 'D', 'F', 'Z']
     '''
@@ -49,29 +64,35 @@ def bam_iter(bam, quiet=False, show_ref_pos=False, ref=None, start=None, end=Non
         # Meaning that we should show chrom:pos, instead of read names
         show_ref_pos = True
 
-    eta = None
+    def status(read):
+        if callback:
+            return callback(read)
+        elif show_ref_pos:
+            if read.tid > -1:
+                return '%s:%s %s' % (bam.getrname(read.tid), read.pos, read.qname)
+            return 'unmapped %s' % (read.qname)
+        return '%s' % read.qname
 
     if not ref:
-        if not quiet and bam.filename:
-            eta = ETA(os.stat(bam.filename).st_size)
+        if progress is None and not quiet and bam.filename:
+            progress = default_progress(os.stat(bam.filename).st_size)
 
-        for read in bam:
-            pos = bam.tell()
-            bgz_offset = pos >> 16
+        if progress:
+            every = progress.every
+            countdown = every
 
-            if not quiet and eta:
-                if callback:
-                    eta.print_status(bgz_offset, extra=callback(read))
-                elif (show_ref_pos):
-                    if read.tid > -1:
-                        eta.print_status(bgz_offset, extra='%s:%s %s' % (bam.getrname(read.tid), read.pos, read.qname))
-                    else:
-                        eta.print_status(bgz_offset, extra='unmapped %s' % (read.qname))
-                else:
-                    eta.print_status(bgz_offset, extra='%s' % read.qname)
+        for read in bam:
+            if progress:
+                countdown -= 1
+                if not countdown:
+                    countdown = every
+                    progress.update(every, bam.tell() >> 16, lambda: status(read))
 
             yield read
 
+        if progress:
+            progress.done(every - countdown, bam.tell() >> 16)
+
     else:
         working_chrom = None
         if ref in bam.references:
@@ -91,20 +112,27 @@ def bam_iter(bam, quiet=False, show_ref_pos=False, ref=None, start=None, end=Non
         if not end:
             end = bam.lengths[tid]
 
-        if not quiet and bam.filename:
-            eta = ETA(end - start)
+        show_ref_pos = True
+
+        if progress is None and not quiet and bam.filename:
+            progress = default_progress(end - start)
+
+        if progress:
+            every = progress.every
+            countdown = every
 
+        read = None
         for read in bam.fetch(working_chrom, start, end):
-            if not quiet and eta:
-                if callback:
-                    eta.print_status(read.pos - start, extra=callback(read))
-                else:
-                    eta.print_status(read.pos - start, extra='%s:%s %s' % (bam.getrname(read.tid), read.pos, read.qname))
+            if progress:
+                countdown -= 1
+                if not countdown:
+                    countdown = every
+                    progress.update(every, read.pos - start, lambda: status(read))
 
             yield read
 
-    if eta:
-        eta.done()
+        if progress:
+            progress.done(every - countdown, read.pos - start if read else 0)
 
 
 def bam_batch_reads(bam, quiet=False):
@@ -169,6 +197,357 @@ def cigar_tostr(cigar):
     return s
 
 
+_cigar_consumes_read = (True, True, False, False, True, False, False, True, True)
+_cigar_consumes_ref = (True, False, True, True, False, False, False, True, True)
+
+_md_split_re = re.compile('([^0-9]+)')
+_md_leading_zero_re = re.compile('(?:^|[^0-9])0[0-9]')
+_md_counts = dict([(str(i), i) for i in xrange(1024)])
+
+
+def md_tokenize(md):
+    '''
+    Splits an MD string into a list of match counts and a list of the bases
+    between them (mismatched bases, or deleted bases prefixed with '^'). There
+    is always one more count than there are bases. Returns None if the MD
+    string has numbers with leading zeros.
+
+    >>> md_tokenize('2G0A5^ATGATGTCA27')
+    ([2, 0, 5, 27], ['G', 'A', '^ATGATGTCA'])
+    >>> md_tokenize('C1CC1CTC27')
+    ([0, 1, 1, 27], ['C', 'CC', 'CTC'])
+    '''
+    parts = _md_split_re.split(md)
+    counts = parts[::2]
+    if not counts[0]:
+        counts[0] = '0'
+    if not counts[-1]:
+        counts[-1] = '0'
+
+    try:
+        return map(_md_counts.__getitem__, counts), parts[1::2]
+    except KeyError:
+        # large counts, or counts with leading zeros
+        if _md_leading_zero_re.search(md):
+            return None
+        return map(int, counts), parts[1::2]
+
+
+class DecodedAlignment(object):
+    '''
+    The CIGAR alignment and MD tag for a read, decoded once so that the read_*
+    functions below (and the filter criteria that use them) don't each
+    re-parse them for the same read.
+
+    ops, lengths - CIGAR operations and their lengths
+    ref_offsets  - the reference start of each operation, relative to pos
+    md_tokens    - the MD tag, split by md_tokenize()
+
+    Each of these is only decoded when it is first used. Use decode_read() to
+    get the decoded alignment for a read.
+    '''
+    _ops = None
+    _lengths = None
+    _ref_offsets = None
+    _md = None
+    _md_tokens = None
+    _mismatches = None
+    _variations = None
+
+    def __init__(self, pos, cigar, md=None, read=None):
+        self.pos = pos
+        self.cigar = cigar
+        self.read = read
+        if md is not None:
+            self._md = md
+
+    @property
+    def ops(self):
+        if self._ops is None:
+            self._ops = array.array('B', [op for op, length in self.cigar])
+        return self._ops
+
+    @property
+    def lengths(self):
+        if self._lengths is None:
+            self._lengths = array.array('l', [length for op, length in self.cigar])
+        return self._lengths
+
+    @property
+    def ref_offsets(self):
+        if self._ref_offsets is None:
+            ref_pos = 0
+            offsets = []
+            for op, length in self.cigar:
+                offsets.append(ref_pos)
+                if op < 9 and _cigar_consumes_ref[op]:
+                    ref_pos += length
+            self._ref_offsets = array.array('l', offsets)
+        return self._ref_offsets
+
+    @property
+    def md(self):
+        if self._md is None:
+            self._md = self.read.opt('MD')
+        return self._md
+
+    @property
+    def md_tokens(self):
+        if self._md_tokens is None:
+            self._md_tokens = md_tokenize(self.md)
+        return self._md_tokens
+
+    @property
+    def read_len(self):
+        return cigar_read_len(self.cigar)
+
+    def mismatches(self):
+        'see read_calc_mismatches'
+        if self._mismatches is None:
+            self._mismatches = _calc_mismatches(int(self.read.opt('NM')), self.cigar)
+        return self._mismatches
+
+    def fragments(self):
+        'see _read_alignment_fragments_gen'
+        for op, length, offset in zip(self.ops, self.lengths, self.ref_offsets):
+            if op == 0:
+                yield (self.pos + offset, self.pos + offset + length)
+            elif op > 3:
+                raise ValueError("Unsupported CIGAR operation: %s" % op)
+
+    def variations(self, seq=None):
+        'see _read_calc_variations'
+        if seq is None:
+            if self._variations is None:
+                self._variations = self._token_variations(self.read.seq)
+                if self._variations is None:
+                    self._variations = list(_read_calc_variations_md(self.pos, self.cigar, self.md, self.read.seq))
+            return self._variations
+
+        variations = self._token_variations(seq)
+        if variations is None:
+            variations = list(_read_calc_variations_md(self.pos, self.cigar, self.md, seq))
+        return variations
+
+    def _token_variations(self, seq):
+        '''
+        Finds variations using the MD tokens. Returns None if the MD tokens
+        don't line up with the CIGAR operations (_read_calc_variations_md
+        handles these).
+        '''
+        tokens = self.md_tokens
+        if tokens is None:
+            return None
+
+        counts, bases = tokens
+
+        if len(self.cigar) == 1 and self.cigar[0][0] == 0 and '^' not in self.md:
+            # one M operation and no deletions (most reads)
+            length = self.cigar[0][1]
+            out = []
+            md_pos = counts[0]
+            for chunk, count in zip(bases, counts[1:]):
+                for base in chunk:
+                    if md_pos >= length:
+                        return out
+                    out.append((0, self.pos + md_pos, seq[md_pos]))
+                    md_pos += 1
+                md_pos += count
+            return out
+
+        last = len(bases)
+        i = 0  # bases[i] is next, after {matches} more matches
+        j = 0  # position in bases[i]
+        matches = counts[0]
+
+        out = []
+        ref_pos = self.pos
+        read_pos = 0
+
+        for op, length in self.cigar:
+            if op == 0:  # M
+                md_pos = 0
+                while md_pos < length:
+                    if matches:
+                        if matches > length - md_pos:
+                            matches -= length - md_pos
+                            break
+                        md_pos += matches
+                        matches = 0
+
+                    if i == last:
+                        break
+
+                    chunk = bases[i]
+                    while md_pos < length and j < len(chunk) and chunk[j] != '^':
+                        out.append((op, ref_pos + md_pos, seq[read_pos + md_pos]))
+                        j += 1
+                        md_pos += 1
+
+                    if j == len(chunk):
+                        i += 1
+                        j = 0
+                        matches = counts[i]
+                    elif md_pos < length:
+                        # deletion in the middle of an M operation
+                        return None
+
+                ref_pos += length
+                read_pos += length
+
+            elif op == 1:  # I
+                out.append((op, ref_pos, seq[read_pos:read_pos + length]))
+                read_pos += length
+
+            elif op == 2:  # D
+                if matches or i == last or bases[i][j] != '^' or j + length >= len(bases[i]):
+                    return None
+                out.append((op, ref_pos, bases[i][j + 1:j + length + 1]))
+                j += length + 1
+                if j == len(bases[i]):
+                    i += 1
+                    j = 0
+                    matches = counts[i]
+                ref_pos += length
+
+            elif op == 3:  # N
+                ref_pos += length
+
+        return out
+
+
+_decoded_read = [None]
+
+
+def decode_read(read):
+    '''
+    Returns the DecodedAlignment for a read. The last read decoded is cached,
+    so each read is only decoded once, even if it is used by more than one
+    function. (If the read's alignment is changed, it is decoded again only
+    if it was changed with read_cleancigar)
+    '''
+    decoded = _decoded_read[0]
+    if decoded is None or decoded.read is not read:
+        decoded = _decoded_read[0] = DecodedAlignment(read.pos, read.cigar or [], read=read)
+    return decoded
+
+
+_read_tags = [None, None]  # the last read, and its decoded tags
+
+
+def read_tag(read, name):
+    '''
+    Returns the value of a read's tag (or None if the read doesn't have it).
+    The tags of the last read are cached in a dict, so each tag is only
+    decoded once, even if it is used by more than one function (or filter
+    criterion). (If the read's tags are changed, they are decoded again only
+    if they were changed with set_read_tags)
+    '''
+    if _read_tags[0] is not read:
+        _read_tags[0] = read
+        _read_tags[1] = {}
+
+    tags = _read_tags[1]
+    if name in tags:
+        return tags[name]
+
+    try:
+        value = tags[name] = read.opt(name)
+    except KeyError:
+        value = tags[name] = None
+    return value
+
+
+def set_read_tags(read, tags):
+    'Sets the tags of a read (a list of (name, value) tuples)'
+    read.tags = tags
+    if _read_tags[0] is read:
+        _read_tags[0] = None
+
+
+class DecodedBatch(object):
+    '''
+    The CIGAR alignments for a block of reads, decoded at once with numpy.
+    The operations for all of the reads are kept in flat arrays; the
+    operations for read i are ops[starts[i]:starts[i + 1]].
+
+    pos, nm            - one value per read (nm is -1 if the read has no NM tag)
+    ops, lengths       - CIGAR operations and their lengths
+    ref_offsets        - the reference start of each operation, relative to
+                         the read's pos
+    read_index         - the read for each operation
+    read_lens, ref_lens - one value per read
+    '''
+    def __init__(self, reads):
+        if numpy is None:
+            raise ImportError('numpy is required for DecodedBatch')
+
+        self.reads = reads
+        counts = []
+        ops = []
+        lengths = []
+        pos = []
+        nm = []
+
+        for read in reads:
+            cigar = read.cigar or []
+            counts.append(len(cigar))
+            ops.extend([op for op, length in cigar])
+            lengths.extend([length for op, length in cigar])
+            pos.append(read.pos)
+            try:
+                nm.append(int(read.opt('NM')))
+            except KeyError:
+                nm.append(-1)
+
+        self.pos = numpy.array(pos, dtype=numpy.int64)
+        self.nm = numpy.array(nm, dtype=numpy.int64)
+        self.ops = numpy.array(ops, dtype=numpy.uint8)
+        self.lengths = numpy.array(lengths, dtype=numpy.int64)
+
+        if len(ops) and (self.ops.max() > 8 or (self.ops == 6).any()):
+            raise ValueError("Unsupported CIGAR operation: %s" % self.ops[(self.ops > 8) | (self.ops == 6)][0])
+
+        counts = numpy.array(counts, dtype=numpy.int64)
+        self.starts = numpy.zeros(len(reads) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=self.starts[1:])
+        self.read_index = numpy.repeat(numpy.arange(len(reads)), counts)
+
+        ref_consumed = numpy.array(_cigar_consumes_ref, dtype=numpy.int64)[self.ops] * self.lengths
+        read_consumed = numpy.array(_cigar_consumes_read, dtype=numpy.int64)[self.ops] * self.lengths
+
+        ref_pos = numpy.zeros(len(ops) + 1, dtype=numpy.int64)
+        numpy.cumsum(ref_consumed, out=ref_pos[1:])
+        self.ref_offsets = ref_pos[:-1] - ref_pos[self.starts[:-1]][self.read_index]
+
+        self.ref_lens = numpy.bincount(self.read_index, weights=ref_consumed, minlength=len(reads)).astype(numpy.int64)
+        self.read_lens = numpy.bincount(self.read_index, weights=read_consumed, minlength=len(reads)).astype(numpy.int64)
+
+    def mismatches(self):
+        '''
+        read_calc_mismatches for each read (-1 if the read has no NM tag)
+        '''
+        indels = (self.ops == 1) | (self.ops == 2)
+        adjust = numpy.bincount(self.read_index[indels], weights=self.lengths[indels] - 1, minlength=len(self.reads)).astype(numpy.int64)
+        return numpy.where(self.nm < 0, -1, self.nm - adjust)
+
+    def fragments(self):
+        '''
+        Returns arrays of (read index, start, end) for each M operation. Unlike
+        read_alignment_fragments_gen, reads with other operations (S, H, =, X)
+        are allowed.
+        '''
+        matches = self.ops == 0
+        read_index = self.read_index[matches]
+        starts = self.pos[read_index] + self.ref_offsets[matches]
+        return read_index, starts, starts + self.lengths[matches]
+
+
+def decode_reads(reads):
+    'Decodes a block of reads at once (see DecodedBatch)'
+    return DecodedBatch(reads)
+
+
 def cigar_read_len(cigar):
     '''
     >>> cigar_read_len(cigar_fromstr('8M'))
@@ -184,47 +563,33 @@ def cigar_read_len(cigar):
     read_pos = 0
 
     for op, length in cigar:
-        if op == 0:  # M
-            read_pos += length
-        elif op == 1:  # I
-            read_pos += length
-        elif op == 2:  # D
-            pass
-        elif op == 3:  # N
-            pass
-        elif op == 4:  # S
-            read_pos += length
-        elif op == 5:  # H
-            pass
-        elif op == 7:  # =
-            read_pos += length
-        elif op == 8:  # X
-            read_pos += length
-        else:
+        if op > 8 or op == 6:
             raise ValueError("Unsupported CIGAR operation: %s" % op)
+        if _cigar_consumes_read[op]:
+            read_pos += length
 
     return read_pos
 
 
 def read_calc_mismatches(read):
-    inserts = 0
-    deletions = 0
-    indels = 0
-    edits = int(read.opt('NM'))
-    #
-    # NM counts the length of indels
-    # We really just care about *if* there is an indel, not the size
-    #
+    '''
+    The number of mismatches (from the NM tag), counting each indel as one
+    mismatch (NM counts the length of indels)
+    '''
+    decoded = _decoded_read[0]
+    if decoded is not None and decoded.read is read:
+        return decoded.mismatches()
 
-    for op, length in read.cigar:
-        if op == 1:
-            inserts += length
-            indels += 1
-        elif op == 2:
-            deletions += length
-            indels += 1
+    # decoding the read isn't worth it for this alone
+    return _calc_mismatches(int(read.opt('NM')), read.cigar)
+
+
+def _calc_mismatches(edits, cigar):
+    for op, length in cigar:
+        if op == 1 or op == 2:
+            edits -= length - 1
 
-    return edits - inserts - deletions + indels
+    return edits
 
 
 def _extract_md_matches(md, maxlength):
@@ -248,8 +613,7 @@ def _extract_md_matches(md, maxlength):
 
 def read_calc_variations(read):
     'see _read_calc_variations'
-    for tup in _read_calc_variations(read.pos, read.cigar, read.opt('MD'), read.seq):
-        yield tup
+    return iter(decode_read(read).variations())
 
 
 def _read_calc_variations(start_pos, cigar, md, seq):
@@ -452,6 +816,15 @@ def _read_calc_variations(start_pos, cigar, md, seq):
     >>> list(_read_calc_variations(1, [(0,34), (3,100), (0, 39), (1, 2)], '3T69', 'GGAATCTTCCCACTGGGTCGATGTTGTTTGTGATCTGAGAGAGAGTTGCATCTGCACATGCTTTCCTGGCGTCTC',  ))
     [(0, 4, 'A'), (1, 174, 'TC')]
 
+    '''
+    return DecodedAlignment(start_pos, cigar, md).variations(seq)
+
+
+def _read_calc_variations_md(start_pos, cigar, md, seq):
+    '''
+    Finds variations by parsing the MD string in step with the CIGAR
+    operations. DecodedAlignment.variations() falls back to this when the MD
+    tokens don't line up with the CIGAR operations.
     '''
 
     ref_pos = start_pos
@@ -502,7 +875,90 @@ def _read_calc_variations(start_pos, cigar, md, seq):
             ref_pos += length
 
 
+class RefWindowCache(object):
+    '''
+    Wraps a pysam.Fastafile and keeps one window of reference sequence in
+    memory, so that reads from a sorted BAM file can be compared to the
+    reference without a FASTA lookup for each read. fetch() returns the same
+    sequence as pysam.Fastafile.fetch().
+
+    If a window is replaced after fewer than {min_hits} lookups (as happens
+    with unsorted reads), the next {skip} lookups are fetched directly from
+    the FASTA file instead.
+    '''
+    def __init__(self, ref, window=65536, min_hits=16, skip=1000):
+        self.ref = ref
+        self.filename = ref.filename
+        self.window = window
+        self.min_hits = min_hits
+        self.skip = skip
+
+        self.hits = 0
+        self.misses = 0
+
+        self._chrom = None
+        self._start = 0
+        self._end = 0
+        self._seq = ''
+        self._window_hits = 0
+        self._skipping = 0
+
+    def fetch(self, chrom, start, end):
+        if start >= self._start and end <= self._end and chrom == self._chrom:
+            self.hits += 1
+            self._window_hits += 1
+            return self._seq[start - self._start:end - self._start]
+
+        self.misses += 1
+
+        if self._skipping:
+            self._skipping -= 1
+            return self.ref.fetch(chrom, start, end)
+
+        if self._chrom is not None and self._window_hits < self.min_hits:
+            self._skipping = self.skip
+            self._chrom = None
+            return self.ref.fetch(chrom, start, end)
+
+        self._chrom = chrom
+        self._start = start
+        self._end = max(end, start + self.window)
+        self._seq = self.ref.fetch(chrom, self._start, self._end)
+        self._window_hits = 0
+
+        return self._seq[:end - start]
+
+    def close(self):
+        self.ref.close()
+
+
+def _mismatch_offsets(refseq, readseq):
+    '''
+    Returns the offsets where two (uppercase) sequences differ.
+
+    >>> _mismatch_offsets('ACGTACGT', 'ACCTACGA')
+    [2, 7]
+    >>> _mismatch_offsets('ACGT', 'ACGTACGT')
+    []
+    '''
+    if len(refseq) != len(readseq):
+        length = min(len(refseq), len(readseq))
+        refseq = refseq[:length]
+        readseq = readseq[:length]
+
+    if refseq == readseq:
+        return []
+
+    if numpy is not None:
+        return (numpy.frombuffer(refseq, dtype=numpy.uint8) != numpy.frombuffer(readseq, dtype=numpy.uint8)).nonzero()[0].tolist()
+
+    return [i for i, (refbase, readbase) in enumerate(zip(refseq, readseq)) if refbase != readbase]
+
+
 def read_calc_mismatches_gen(ref, read, chrom):
+    '''
+    ref can be a pysam.Fastafile or a RefWindowCache (faster for sorted reads)
+    '''
     start = read.pos
     ref_pos = 0
     read_pos = 0
@@ -520,11 +976,10 @@ def read_calc_mismatches_gen(ref, read, chrom):
             refseq = ref.fetch(chrom, start + ref_pos, start + ref_pos + length)
             if not refseq:
                 raise ValueError("Reference '%s' not found in FASTA file: %s" % (chrom, ref.filename))
+            readseq = read.seq[read_pos:read_pos + length].upper()
             cur_pos = start + ref_pos
-            for refbase, readbase in zip(refseq.upper(), read.seq[read_pos:read_pos + length].upper()):
-                if refbase != readbase:
-                    yield op, cur_pos, readbase
-                cur_pos += 1
+            for offset in _mismatch_offsets(refseq.upper(), readseq):
+                yield op, cur_pos + offset, readseq[offset]
             ref_pos += length
             read_pos += length
         else:
@@ -721,7 +1176,7 @@ def read_alignment_fragments_gen(read):
     This will let us know where each read alignment "touches" the genome.
     '''
 
-    for start, end in _read_alignment_fragments_gen(read.pos, read.cigar):
+    for start, end in decode_read(read).fragments():
         yield (start, end)
 
 
@@ -736,20 +1191,8 @@ def _read_alignment_fragments_gen(pos, cigar):
     >>> list(_read_alignment_fragments_gen(1, cigar_fromstr('20M1D4M100N10M5I10M')))
     [(1, 21), (22, 26), (126, 136), (136, 146)]
     '''
-    ref_pos = pos
-
-    for op, length in cigar:
-        if op == 0:
-            yield (ref_pos, ref_pos + length)
-            ref_pos += length
-        elif op == 1:
-            pass
-        elif op == 2:
-            ref_pos += length
-        elif op == 3:
-            ref_pos += length
-        else:
-            raise ValueError("Unsupported CIGAR operation: %s" % op)
+    for start, end in DecodedAlignment(pos, cigar).fragments():
+        yield (start, end)
 
 
 def read_cigar_at_pos(cigar, qpos, is_del):
@@ -833,6 +1276,7 @@ def read_cleancigar(read):
 
     if newcigar:
         read.cigar = newcigar
+        _decoded_read[0] = None
         return True
 
     return False
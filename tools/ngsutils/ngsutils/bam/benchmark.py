@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''
+Benchmark counting read mismatches against a reference (bamutils filter
+-mismatch_ref).
+
+Compares the original read_calc_mismatches_gen (a FASTA lookup for each
+M block and a base-by-base comparison) with the current version, both with a
+pysam.Fastafile and with a RefWindowCache. All versions are checked to find
+the same mismatches.
+
+Usage: benchmark.py {-reads N} {-seed N} {ref.fa in.bam}
+
+If no files are given, a random 5Mb reference and sorted 100bp reads (with
+0-4 mismatches each) are used.
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pysam
+from ngsutils.bam import RefWindowCache, read_calc_mismatches_gen
+
+
+def orig_read_calc_mismatches_gen(ref, read, chrom):
+    'The original read_calc_mismatches_gen'
+    start = read.pos
+    ref_pos = 0
+    read_pos = 0
+
+    for op, length in read.cigar:
+        if op == 1:
+            yield ref_pos, op, None
+            read_pos += length
+        elif op == 2:
+            yield ref_pos, op, None
+            ref_pos += length
+        elif op == 3:
+            ref_pos += length
+        elif op == 0:
+            refseq = ref.fetch(chrom, start + ref_pos, start + ref_pos + length)
+            if not refseq:
+                raise ValueError("Reference '%s' not found in FASTA file: %s" % (chrom, ref.filename))
+            cur_pos = start + ref_pos
+            for refbase, readbase in zip(refseq.upper(), read.seq[read_pos:read_pos + length].upper()):
+                if refbase != readbase:
+                    yield op, cur_pos, readbase
+                cur_pos += 1
+            ref_pos += length
+            read_pos += length
+        else:
+            raise ValueError("Unsupported CIGAR operation: %s" % op)
+
+
+def synthetic_reads(tmpdir, count, readlen=100, size=5000000, seed=1):
+    '''
+    Writes a random reference to {tmpdir}/ref.fa and returns it with a list
+    of (chrom, read) for {count} sorted reads
+    '''
+    rand = random.Random(seed)
+    refseq = ''.join([rand.choice('ACGT') for i in xrange(size)])
+
+    fname = os.path.join(tmpdir, 'ref.fa')
+    with open(fname, 'w') as f:
+        f.write('>chr1\n')
+        for i in xrange(0, size, 60):
+            f.write('%s\n' % refseq[i:i + 60])
+
+    reads = []
+    for pos in sorted([rand.randint(0, size - readlen) for i in xrange(count)]):
+        seq = list(refseq[pos:pos + readlen])
+        for offset in rand.sample(xrange(readlen), rand.randint(0, 4)):
+            seq[offset] = rand.choice([base for base in 'ACGT' if base != seq[offset]])
+
+        read = pysam.AlignedRead()
+        read.qname = 'read%s' % len(reads)
+        read.seq = ''.join(seq)
+        read.tid = 0
+        read.pos = pos
+        read.cigar = [(0, readlen)]
+        reads.append(('chr1', read))
+
+    return fname, reads
+
+
+def bam_reads(fname, count):
+    bam = pysam.Samfile(fname)
+    reads = []
+    for read in bam:
+        if read.is_unmapped:
+            continue
+        reads.append((bam.getrname(read.tid), read))
+        if len(reads) >= count:
+            break
+    bam.close()
+    return reads
+
+
+def benchmark(refname, reads, out=sys.stdout):
+    out.write('%s reads\n' % len(reads))
+
+    results = []
+    for name, func, cached in [('original', orig_read_calc_mismatches_gen, False),
+                               ('vectorized', read_calc_mismatches_gen, False),
+                               ('window cache', read_calc_mismatches_gen, True)]:
+        ref = pysam.Fastafile(refname)
+        if cached:
+            ref = RefWindowCache(ref)
+
+        start = time.time()
+        mismatches = []
+        for chrom, read in reads:
+            mismatches.append(list(func(ref, read, chrom)))
+        elapsed = time.time() - start
+        ref.close()
+
+        found = sum([len(x) for x in mismatches])
+        out.write('    %-14s %8.3fs (%.0f reads/s, %s mismatches)\n' % (name, elapsed, len(reads) / elapsed, found))
+        results.append(mismatches)
+
+    if results[0] != results[1] or results[0] != results[2]:
+        out.write('    ERROR: mismatches differ!\n')
+
+
+if __name__ == '__main__':
+    fnames = []
+    num_reads = 200000
+    seed = 1
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-reads':
+            num_reads = int(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif arg in ['-reads', '-seed']:
+            last = arg
+        elif arg == '-h':
+            print __doc__
+            sys.exit(1)
+        else:
+            fnames.append(arg)
+
+    if fnames:
+        if len(fnames) != 2:
+            print __doc__
+            sys.exit(1)
+        benchmark(fnames[0], bam_reads(fnames[1], num_reads))
+    else:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            refname, reads = synthetic_reads(tmpdir, num_reads, seed=seed)
+            pysam.faidx(refname)
+            benchmark(refname, reads)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+Benchmark the tag criteria used by bamutils filter (-lt, -gte, -eq...).
+
+Compares the original tag lookup (each criterion scans read.tags, so all of
+the tags are decoded again for each criterion) with read_tag (each tag that
+is used is decoded once per read, into a dict shared by all criteria). Both
+are run with 1 to 5 tag criteria on the same synthetic reads, and checked to
+give the same results.
+
+Usage: benchmark_tags.py {-reads N} {-seed N}
+'''
+
+import random
+import sys
+import time
+
+import pysam
+from ngsutils.bam import read_tag
+
+_criteria = [('AS', '>=', -20), ('NM', '<', 3), ('NH', '==', 1), ('XS', '<', -10), ('HI', '<=', 1)]
+
+_ops = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b,
+}
+
+
+class OrigTagCompare(object):
+    'The original _TagCompare lookup (a scan of read.tags for each criterion)'
+    def __init__(self, tag, op, value):
+        self.tag = tag
+        self.op = _ops[op]
+        self.value = value
+
+    def get_value(self, read):
+        for name, value in read.tags:
+            if name == self.tag:
+                return value
+        return None
+
+    def filter(self, bam, read):
+        return self.op(self.get_value(read), self.value)
+
+
+class TagCompare(OrigTagCompare):
+    'The current _TagCompare lookup (read_tag)'
+    def get_value(self, read):
+        return read_tag(read, self.tag)
+
+
+def random_reads(count, seed=1):
+    'Reads with the tags of a typical aligner (MD, NM, AS, XS, NH, HI, RG)'
+    rand = random.Random(seed)
+    reads = []
+    for i in xrange(count):
+        read = pysam.AlignedRead()
+        read.qname = 'read%s' % i
+        read.seq = 'A' * 100
+        read.cigar = [(0, 100)]
+        read.pos = i * 10
+        read.mapq = 255
+        nm = rand.randint(0, 4)
+        read.tags = [('MD', '%sA%s' % (rand.randint(0, 50), rand.randint(0, 49))), ('NM', nm), ('AS', -6 * nm), ('XS', -rand.randint(0, 30)), ('NH', rand.randint(1, 3)), ('HI', 1), ('RG', 'sample1')]
+        reads.append(read)
+    return reads
+
+
+def benchmark(reads, out=sys.stdout):
+    out.write('tag criteria: %s reads\n' % len(reads))
+
+    for count in xrange(1, len(_criteria) + 1):
+        results = []
+        times = []
+        for criterion_class in [OrigTagCompare, TagCompare]:
+            criteria = [criterion_class(*args) for args in _criteria[:count]]
+
+            start = time.time()
+            passed = []
+            for read in reads:
+                for criterion in criteria:
+                    if not criterion.filter(None, read):
+                        passed.append(False)
+                        break
+                else:
+                    passed.append(True)
+            times.append(time.time() - start)
+            results.append(passed)
+
+        out.write('    %s criteria    orig: %6.2f us/read    read_tag: %6.2f us/read    (%.1fx)\n' % (count, times[0] * 1000000 / len(reads), times[1] * 1000000 / len(reads), times[0] / times[1]))
+
+        if results[0] != results[1]:
+            out.write('    ERROR: tag criteria returned different results!\n')
+
+
+if __name__ == '__main__':
+    num_reads = 200000
+    seed = 1
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-reads':
+            num_reads = int(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif arg in ['-reads', '-seed']:
+            last = arg
+        else:
+            print __doc__
+            sys.exit(1)
+
+    benchmark(random_reads(num_reads, seed=seed))
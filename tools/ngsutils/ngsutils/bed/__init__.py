@@ -1,8 +1,16 @@
+import array
+import bisect
+import heapq
 import os
 
 import ngsutils.support.ngs_utils
 import pysam
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class BedStreamer(object):
     '''
@@ -34,29 +42,92 @@ class BedStreamer(object):
             raise StopIteration
 
 
-class BedFile(object):
+class BedSweep(object):
     '''
-    BED files are read in their entirety memory, in a series of bins. Each bin
-    is ~100kb in size. Each bin can then be iterated over.
+    Finds the regions from a sorted BED stream that overlap a series of sorted
+    queries (for example, reads from a coordinate sorted BAM file).
+
+    The BED stream is advanced in lockstep with the queries, and only the
+    regions that could still overlap a query are kept (in a heap, ordered by
+    end position). This means the total work is O(queries + regions), and
+    memory is bounded by the number of overlapping regions, not the size of
+    the BED file.
+
+    The BED regions must be sorted by chrom (in the same order as chroms) and
+    start. The queries must also be sorted by chrom and start. Regions on
+    chromosomes not in chroms are skipped.
+    '''
+
+    def __init__(self, regions, chroms):
+        self._regions = iter(regions)
+        self._order = dict([(chrom, i) for i, chrom in enumerate(chroms)])
+        self._active = []
+        self._count = 0
+
+        self._query = (-1, -1)
+        self._next = None
+        self._next_key = (-1, -1)
+        self.__load_next()
+
+    def __load_next(self):
+        for region in self._regions:
+            if region.chrom not in self._order:
+                continue
+
+            key = (self._order[region.chrom], region.start)
+            if key < self._next_key:
+                raise ValueError('BED regions are not sorted (%s:%s)' % (region.chrom, region.start))
+
+            self._next = region
+            self._next_key = key
+            return
+
+        self._next = None
+
+    def fetch(self, chrom, start, end, strand=None):
+        '''
+        Yields the regions that overlap start-end (inclusive), in no particular
+        order.
+        '''
+        query = (self._order[chrom], start)
+        if query < self._query:
+            raise ValueError('Queries are not sorted (%s:%s)' % (chrom, start))
+
+        if query[0] != self._query[0]:
+            self._active = []
+        self._query = query
+
+        while self._next and (self._next_key[0] < query[0] or (self._next_key[0] == query[0] and self._next.start <= end)):
+            if self._next_key[0] == query[0]:
+                self._count += 1
+                heapq.heappush(self._active, (self._next.end, self._count, self._next))
+            self.__load_next()
+
+        while self._active and self._active[0][0] < start:
+            heapq.heappop(self._active)
 
-    This is less efficient than using a proper index, but in reality, this
-    usually isn't an issue. However, if the BED file has been Tabix indexed,
-    that index will be used for random access.
+        for region_end, count, region in self._active:
+            if region.start <= end and (not strand or strand == region.strand):
+                yield region
 
-    NOTE: This isn't very efficient, so perhaps this can be remodeled into a BedFile
-    and a BedFileIndex where the file is indexed only if random access is requested.
+
+class BedFile(object):
     '''
+    BED files are read in their entirety into memory. The regions can then be
+    iterated over (sorted by chrom, start, end, strand, name).
 
-    _bin_const = 100000
+    The regions are stored by column (see BedColumns), and BedRegions are
+    only created as they are iterated over (or returned by fetch).
+
+    For random access (fetch), the regions are indexed the first time fetch
+    is called (see BedFileIndex). However, if the BED file has been Tabix
+    indexed, that index will be used for random access instead.
+    '''
 
     def __init__(self, fname=None, fileobj=None, region=None):
-        self._bins = {}
-        self._bin_list = []
-        self._cur_bin_idx = 0
-        self._cur_bin_pos = 0
+        self._regions = BedColumns()
+        self._index = None
         self._tellpos = 0
-        self._total = 0
-        self._length = 0
         self.__tabix = None
 
         self.filename = fname
@@ -78,44 +149,25 @@ class BedFile(object):
                 end = start
             start -= 1
 
-            self.__add_region(BedRegion(chrom, start, end))
+            self._regions.append([chrom, start, end])
         else:
             raise ValueError("Must specify either filename, fileobj, or region")
 
     def __readfile(self, fobj):
+        append = self._regions.append
         for line in fobj:
             line = line.strip()
             if line and line[0] != '#':
-                cols = line.split('\t')
-                while len(cols) < 6:
-                    cols.append('')
-
-                region = BedRegion(*cols)
-                self.__add_region(region)
-
-        self._bin_list.sort()
-        for bin in self._bins:
-            self._bins[bin].sort()
-
-    def __add_region(self, region):
-        self._total += region.end - region.start
-        self._length += 1
-
-        startbin = region.start / BedFile._bin_const
-        endbin = region.end / BedFile._bin_const
+                append(line.split('\t'))
 
-        for bin in xrange(startbin, endbin + 1):
-            if not (region.chrom, bin) in self._bins:
-                self._bin_list.append((region.chrom, bin))
-                self._bins[(region.chrom, bin)] = []
-            self._bins[(region.chrom, bin)].append(region)
+        self._regions.sort()
 
     def fetch(self, chrom, start, end, strand=None):
         '''
         For TABIX indexed BED files, find all regions w/in a range
 
-        For non-TABIX index BED files, use the calculated bins, and
-        output matching regions
+        For non-TABIX index BED files, use the BedFileIndex (built on the
+        first call), and output matching regions
         '''
 
         if self.__tabix:
@@ -124,24 +176,11 @@ class BedFile(object):
                 if not strand or (strand and region.strand == strand):
                     yield region
         else:
-            startbin = start / BedFile._bin_const
-            endbin = end / BedFile._bin_const
-
-            buf = set()
-
-            for bin in xrange(startbin, endbin + 1):
-                if (chrom, bin) in self._bins:
-                    for region in self._bins[(chrom, bin)]:
-                        if strand and strand != region.strand:
-                            continue
-                        if start <= region.start <= end or start <= region.end <= end:
-                            if region not in buf:
-                                yield region
-                                buf.add(region)
-                        elif region.start < start and region.end > end:
-                            if region not in buf:
-                                yield region
-                                buf.add(region)
+            if self._index is None:
+                self._index = BedFileIndex(self._regions)
+
+            for region in self._index.fetch(chrom, start, end, strand):
+                yield region
 
     def tell(self):
         return self._tellpos
@@ -151,38 +190,325 @@ class BedFile(object):
 
     @property
     def length(self):
-        return self._length
+        return len(self._regions)
 
     @property
     def total(self):
-        return self._total
+        return self._regions.total
 
     def __iter__(self):
-        self._cur_bin_idx = 0
-        self._cur_bin_pos = 0
         self._tellpos = 0
         return self
 
     def next(self):
-        if self._cur_bin_idx >= len(self._bin_list):
+        if self._tellpos >= len(self._regions):
             raise StopIteration
 
-        binvals = self._bins[self._bin_list[self._cur_bin_idx]]
-        while self._cur_bin_pos < len(binvals):
-            val = binvals[self._cur_bin_pos]
-            self._cur_bin_pos += 1
+        self._tellpos += 1
+        return self._regions[self._tellpos - 1]
+
+
+class BedColumns(object):
+    '''
+    Compact storage for the regions of a BedFile. The chrom, start, end and
+    strand of each region are kept in arrays (chroms and strands as codes),
+    and the other columns as one string per region. A BedRegion is created
+    for a region when it is needed (regions[i]).
+
+    This takes about a tenth of the memory of a list of BedRegions.
+    '''
 
-            startbin = (val.chrom, val.start / BedFile._bin_const)
-            if startbin == self._bin_list[self._cur_bin_idx]:
-                self._tellpos += 1
-                return val
+    def __init__(self):
+        self.chrom_names = []
+        self.strand_names = [None]
+        self.chroms = array.array('i')
+        self.starts = array.array('l')
+        self.ends = array.array('l')
+        self.strands = array.array('B')
+        self.rest = []
+        self.total = 0
 
-        self._cur_bin_idx += 1
-        self._cur_bin_pos = 0
-        return self.next()
+        self._chrom_codes = {}
+        self._strand_codes = {None: 0}
+
+    def append(self, cols):
+        '''
+        Adds a region from its BED columns (chrom, start, end, name, ...). The
+        columns after end are kept as text.
+        '''
+        chrom = cols[0]
+        start = int(cols[1])
+        end = int(cols[2])
+        strand = cols[5] or None if len(cols) > 5 else None
+
+        if chrom not in self._chrom_codes:
+            self._chrom_codes[chrom] = len(self.chrom_names)
+            self.chrom_names.append(chrom)
+        if strand not in self._strand_codes:
+            self._strand_codes[strand] = len(self.strand_names)
+            self.strand_names.append(strand)
+
+        self.chroms.append(self._chrom_codes[chrom])
+        self.starts.append(start)
+        self.ends.append(end)
+        self.strands.append(self._strand_codes[strand])
+        self.rest.append('\t'.join(cols[3:]))
+        self.total += end - start
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        rest = self.rest[i]
+        if rest:
+            return BedRegion(self.chrom_names[self.chroms[i]], self.starts[i], self.ends[i], *rest.split('\t'))
+        return BedRegion(self.chrom_names[self.chroms[i]], self.starts[i], self.ends[i])
+
+    def __iter__(self):
+        for i in xrange(len(self.starts)):
+            yield self[i]
+
+    def strand(self, i):
+        return self.strand_names[self.strands[i]]
+
+    def _name(self, i):
+        return self.rest[i].split('\t', 1)[0]
+
+    def sort(self):
+        '''
+        Sorts the regions by chrom, start, end, strand and name (the same
+        order as sorting BedRegions). The sort is stable.
+        '''
+        count = len(self)
+        if count < 2:
+            return
+
+        chrom_ranks = BedColumns.__ranks(self.chrom_names)
+        strand_ranks = BedColumns.__ranks(self.strand_names)
+
+        if numpy is None:
+            order = sorted(xrange(count), key=lambda i: (chrom_ranks[self.chroms[i]], self.starts[i], self.ends[i], strand_ranks[self.strands[i]], self._name(i)))
+            if order != range(count):
+                self.chroms = array.array('i', [self.chroms[i] for i in order])
+                self.starts = array.array('l', [self.starts[i] for i in order])
+                self.ends = array.array('l', [self.ends[i] for i in order])
+                self.strands = array.array('B', [self.strands[i] for i in order])
+                self.rest = [self.rest[i] for i in order]
+            return
+
+        chroms = numpy.array(chrom_ranks, dtype=numpy.int64)[numpy.frombuffer(self.chroms, dtype=numpy.intc)]
+        starts = numpy.frombuffer(self.starts, dtype=numpy.int_)
+        ends = numpy.frombuffer(self.ends, dtype=numpy.int_)
+        strands = numpy.array(strand_ranks, dtype=numpy.int64)[numpy.frombuffer(self.strands, dtype=numpy.uint8)]
+
+        order = numpy.lexsort((strands, ends, starts, chroms))
+        if (order == numpy.arange(count)).all():
+            order = None
+
+        # runs of regions with the same chrom, start, end and strand are then
+        # sorted by name
+        ordered = numpy.arange(count) if order is None else order
+        same = (chroms[ordered[1:]] == chroms[ordered[:-1]]) & (starts[ordered[1:]] == starts[ordered[:-1]]) & (ends[ordered[1:]] == ends[ordered[:-1]]) & (strands[ordered[1:]] == strands[ordered[:-1]])
+        ties = numpy.flatnonzero(same)
+        if len(ties):
+            breaks = numpy.flatnonzero(numpy.diff(ties) != 1) + 1
+            run_starts = ties[numpy.concatenate(([0], breaks))].tolist()
+            run_ends = (ties[numpy.concatenate((breaks - 1, [len(ties) - 1]))] + 2).tolist()
+
+            ordered = ordered.tolist()
+            for lo, hi in zip(run_starts, run_ends):
+                ordered[lo:hi] = sorted(ordered[lo:hi], key=self._name)
+            ordered = numpy.array(ordered)
+            if (ordered != numpy.arange(count)).any():
+                order = ordered
+
+        if order is None:
+            return
+
+        self.chroms = BedColumns.__take(self.chroms, numpy.intc, order)
+        self.starts = BedColumns.__take(self.starts, numpy.int_, order)
+        self.ends = BedColumns.__take(self.ends, numpy.int_, order)
+        self.strands = BedColumns.__take(self.strands, numpy.uint8, order)
+        self.rest = [self.rest[i] for i in order.tolist()]
+
+    @staticmethod
+    def __ranks(names):
+        'The rank of each name (by code)'
+        ranks = [0] * len(names)
+        for rank, code in enumerate(sorted(xrange(len(names)), key=names.__getitem__)):
+            ranks[code] = rank
+        return ranks
+
+    @staticmethod
+    def __take(arr, dtype, order):
+        'Reorders an array.array (with numpy)'
+        out = array.array(arr.typecode)
+        out.fromstring(numpy.frombuffer(arr, dtype=dtype)[order].tostring())
+        return out
+
+
+class BedFileIndex(object):
+    '''
+    Random access index for a list of BedRegions (or a BedColumns).
+
+    For each chromosome, the regions are stored sorted by start position and
+    treated as an implicit binary tree: leaves are the even positions, and the
+    node at level k are the positions where the lowest k bits are all set.
+    Each node also stores the maximum end position of its subtree, so whole
+    subtrees can be skipped during a lookup. (This is the same layout as Heng
+    Li's cgranges.)
+
+    Building the index is O(n log n), and a lookup is O(log n + matches).
+    Regions are returned in sorted order, and each region is only stored
+    once, no matter how large it is.
+
+    Most lookups don't need the tree: the running maximum of the end
+    positions lets bisect find the span of candidate regions directly. The
+    tree is only walked if that span is large (because of a large region
+    upstream of the query).
+    '''
+
+    _scan_limit = 32
+
+    def __init__(self, regions):
+        self._chroms = {}
+
+        if isinstance(regions, BedColumns):
+            # already sorted, so each chromosome is one run of regions
+            codes = regions.chroms
+            lo = 0
+            while lo < len(codes):
+                code = codes[lo]
+                hi = lo + 1
+                while hi < len(codes) and codes[hi] == code:
+                    hi += 1
+
+                strands = [regions.strand_names[x] for x in regions.strands[lo:hi]]
+                self._chroms[regions.chrom_names[code]] = BedFileIndex.__chrom_index(regions, lo, regions.starts[lo:hi], regions.ends[lo:hi], strands)
+                lo = hi
+            return
+
+        for region in regions:
+            if region.chrom not in self._chroms:
+                self._chroms[region.chrom] = []
+            self._chroms[region.chrom].append(region)
+
+        for chrom in self._chroms:
+            chrom_regions = self._chroms[chrom]
+            chrom_regions.sort()
+            starts = [region.start for region in chrom_regions]
+            ends = [region.end for region in chrom_regions]
+            strands = [region.strand for region in chrom_regions]
+            self._chroms[chrom] = BedFileIndex.__chrom_index(chrom_regions, 0, starts, ends, strands)
+
+    @staticmethod
+    def __chrom_index(regions, offset, starts, ends, strands):
+        '''
+        The index for one chromosome. regions[offset + i] is the region with
+        starts[i], ends[i] and strands[i].
+        '''
+        maxends, root_k = BedFileIndex._index_core(ends)
+
+        running_max = ends[:0]
+        acc = ends[0]
+        for val in ends:
+            if val > acc:
+                acc = val
+            running_max.append(acc)
+
+        return (regions, offset, starts, ends, strands, running_max, maxends, root_k)
+
+    @staticmethod
+    def _index_core(ends):
+        '''
+        Returns the max end position of each node's subtree, and the level of
+        the root node.
+        '''
+        n = len(ends)
+        maxends = ends[:]
+
+        last_i = (n - 1) & ~1
+        last = maxends[last_i]
+
+        k = 1
+        while (1 << k) <= n:
+            x = 1 << (k - 1)
+            for i in xrange((x << 1) - 1, n, x << 2):
+                left = maxends[i - x]
+                right = maxends[i + x] if i + x < n else last
+                maxends[i] = max(ends[i], left, right)
+
+            if (last_i >> k) & 1:
+                last_i -= x
+            else:
+                last_i += x
+
+            if last_i < n and maxends[last_i] > last:
+                last = maxends[last_i]
+            k += 1
+
+        return maxends, k - 1
+
+    def fetch(self, chrom, start, end, strand=None):
+        '''
+        Yields all regions that overlap start-end (inclusive)
+        '''
+        if chrom not in self._chroms:
+            return
+
+        regions, offset, starts, ends, strands, running_max, maxends, root_k = self._chroms[chrom]
+        n = len(starts)
+
+        # candidates have start <= end, and (running) max end >= start
+        hi = bisect.bisect_right(starts, end)
+        lo = bisect.bisect_left(running_max, start, 0, hi)
+
+        if hi - lo <= BedFileIndex._scan_limit:
+            for i in xrange(lo, hi):
+                if ends[i] >= start and (not strand or strand == strands[i]):
+                    yield regions[offset + i]
+            return
+
+        matches = []
+        stack = [(root_k, (1 << root_k) - 1, False)]
+        while stack:
+            k, x, left_done = stack.pop()
+            if k <= 3:
+                # small subtree, just scan it
+                i0 = x >> k << k
+                i1 = min(i0 + (1 << (k + 1)) - 1, n)
+                for i in xrange(i0, i1):
+                    if starts[i] > end:
+                        break
+                    if ends[i] >= start:
+                        matches.append(i)
+
+            elif not left_done:
+                stack.append((k, x, True))
+                y = x - (1 << (k - 1))
+                # the left child may be out of range, but part of its subtree isn't
+                if y >= n or maxends[y] >= start:
+                    stack.append((k - 1, y, False))
+
+            elif x < n and starts[x] <= end:
+                if ends[x] >= start:
+                    matches.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+
+        for i in matches:
+            if not strand or strand == strands[i]:
+                yield regions[offset + i]
+
+
+def _blank_none(val):
+    if val == '':
+        return None
+    return val
 
 
 class BedRegion(object):
+    __slots__ = ('chrom', 'start', 'end', 'name', 'score', 'strand', 'thickStart', 'thickEnd', 'rgb', 'extras')
+
     def __init__(self, chrom, start, end, name='', score='', strand='', thickStart='', thickEnd='', rgb='', *args):
         self.chrom = chrom
         self.start = int(start)
@@ -217,24 +543,30 @@ class BedRegion(object):
         self.extras = args
 
     def clone(self, chrom=None, start=None, end=None, name=None, score=None, strand=None, thickStart=None, thickEnd=None, rgb=None, *args):
-        cols = []
-        cols.append(self.chrom if chrom is None else chrom)
-        cols.append(self.start if start is None else start)
-        cols.append(self.end if end is None else end)
-        cols.append(self.name if name is None else name)
-        cols.append(self.score if score is None else score)
-        cols.append(self.strand if strand is None else strand)
-        cols.append(self.thickStart if thickStart is None else thickStart)
-        cols.append(self.thickEnd if thickEnd is None else thickEnd)
-        cols.append(self.rgb if rgb is None else rgb)
-
-        for i, val in enumerate(self.extras):
-            if len(args) > i:
-                cols.append(args[i])
-            else:
-                cols.append(val)
+        '''
+        Returns a copy of this region, with any of the columns replaced. Only
+        the replaced columns are parsed again.
+        '''
+        region = BedRegion.__new__(BedRegion)
+        region.chrom = self.chrom if chrom is None else chrom
+        region.start = self.start if start is None else int(start)
+        region.end = self.end if end is None else int(end)
+        region.name = self.name if name is None else name
+
+        if score is None:
+            region.score = float(self.score)
+        elif score == '':
+            region.score = 0
+        else:
+            region.score = float(score)
+
+        region.strand = self.strand if strand is None else _blank_none(strand)
+        region.thickStart = self.thickStart if thickStart is None else _blank_none(thickStart)
+        region.thickEnd = self.thickEnd if thickEnd is None else _blank_none(thickEnd)
+        region.rgb = self.rgb if rgb is None else _blank_none(rgb)
+        region.extras = args[:len(self.extras)] + self.extras[len(args):]
 
-        return BedRegion(*cols)
+        return region
 
     @property
     def score_int(self):
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+'''
+Benchmark random access into BED regions.
+
+Compares the BedFileIndex (used by BedFile.fetch) with the original scheme of
+storing regions in ~100kb (chrom, bin) lists. Both indexes are built from the
+same regions, queried with the same random read-sized windows, and checked to
+return the same regions.
+
+Usage: benchmark.py {-queries N} {-seed N} {file.bed...}
+
+If no BED files are given, two synthetic BED files are used:
+    exome   ~200,000 regions of 100-300bp (plus a few large regions)
+    genome  ~2,000,000 regions of 100-6,000bp (like a repeat mask)
+'''
+
+import random
+import sys
+import time
+
+from ngsutils.bed import BedFile, BedFileIndex, BedRegion
+
+_chrom_sizes = [('chr%s' % (i + 1), size) for i, size in enumerate([
+    248956422, 242193529, 198295559, 190214555, 181538259, 170805979,
+    159345973, 145138636, 138394717, 133797422, 135086622, 133275309,
+    114364328, 107043718, 101991189, 90338345, 83257441, 80373285,
+    58617616, 64444167, 46709983, 50818468])]
+
+
+class BinIndex(object):
+    '''
+    The original BedFile index: each region is stored in every ~100kb bin
+    that it touches.
+    '''
+    _bin_const = 100000
+
+    def __init__(self, regions):
+        self._bins = {}
+
+        for region in regions:
+            startbin = region.start / BinIndex._bin_const
+            endbin = region.end / BinIndex._bin_const
+
+            for bin in xrange(startbin, endbin + 1):
+                if not (region.chrom, bin) in self._bins:
+                    self._bins[(region.chrom, bin)] = []
+                self._bins[(region.chrom, bin)].append(region)
+
+        for bin in self._bins:
+            self._bins[bin].sort()
+
+    def fetch(self, chrom, start, end, strand=None):
+        startbin = start / BinIndex._bin_const
+        endbin = end / BinIndex._bin_const
+
+        buf = set()
+
+        for bin in xrange(startbin, endbin + 1):
+            if (chrom, bin) in self._bins:
+                for region in self._bins[(chrom, bin)]:
+                    if strand and strand != region.strand:
+                        continue
+                    if start <= region.start <= end or start <= region.end <= end:
+                        if region not in buf:
+                            yield region
+                            buf.add(region)
+                    elif region.start < start and region.end > end:
+                        if region not in buf:
+                            yield region
+                            buf.add(region)
+
+
+def synthetic_regions(count, minlen, maxlen, large=0, seed=1):
+    '''
+    Returns {count} random regions spread over the human-sized chromosomes,
+    plus {large} regions of 1-5Mb.
+    '''
+    rand = random.Random(seed)
+    genome_size = sum([size for chrom, size in _chrom_sizes])
+
+    regions = []
+    for chrom, size in _chrom_sizes:
+        for i in xrange(count * size / genome_size):
+            start = rand.randint(0, size - maxlen)
+            end = start + rand.randint(minlen, maxlen)
+            regions.append(BedRegion(chrom, start, end, 'region', 0, rand.choice('+-')))
+
+        for i in xrange(large):
+            start = rand.randint(0, size - 5000000)
+            end = start + rand.randint(1000000, 5000000)
+            regions.append(BedRegion(chrom, start, end, 'large', 0, rand.choice('+-')))
+
+    regions.sort()
+    return regions
+
+
+def random_queries(count, readlen=100, seed=1):
+    rand = random.Random(seed)
+    queries = []
+    for i in xrange(count):
+        chrom, size = rand.choice(_chrom_sizes)
+        start = rand.randint(0, size - readlen)
+        queries.append((chrom, start, start + readlen, rand.choice([None, '+', '-'])))
+    return queries
+
+
+def benchmark(name, regions, queries, out=sys.stdout):
+    out.write('%s: %s regions, %s queries\n' % (name, len(regions), len(queries)))
+
+    results = []
+    for index_class in [BinIndex, BedFileIndex]:
+        start = time.time()
+        index = index_class(regions)
+        build = time.time() - start
+
+        start = time.time()
+        matches = []
+        for chrom, qstart, qend, strand in queries:
+            matches.append([id(region) for region in index.fetch(chrom, qstart, qend, strand)])
+        elapsed = time.time() - start
+
+        found = sum([len(x) for x in matches])
+        out.write('    %-12s build: %8.3fs    fetch: %8.3fs (%.1f us/query, %s matches)\n' % (index_class.__name__, build, elapsed, elapsed * 1000000 / len(queries), found))
+        results.append(matches)
+
+    if results[0] != results[1]:
+        out.write('    ERROR: indexes returned different regions!\n')
+
+
+if __name__ == '__main__':
+    fnames = []
+    num_queries = 100000
+    seed = 1
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-queries':
+            num_queries = int(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif arg in ['-queries', '-seed']:
+            last = arg
+        elif arg == '-h':
+            print __doc__
+            sys.exit(1)
+        else:
+            fnames.append(arg)
+
+    queries = random_queries(num_queries, seed=seed)
+
+    if fnames:
+        for fname in fnames:
+            benchmark(fname, list(BedFile(fname)), queries)
+    else:
+        benchmark('exome', synthetic_regions(200000, 100, 300, large=1, seed=seed), queries)
+        benchmark('genome', synthetic_regions(2000000, 100, 6000, large=5, seed=seed), queries)
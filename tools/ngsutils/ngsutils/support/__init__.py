@@ -1,12 +1,12 @@
 import collections
 import gzip
+import mmap
 import os
-import re
+import string
 import sys
-try:
-    from eta import ETA
-except:
-    pass
+
+from ngsutils.support.bgzip import bgzf_aware_open
+from ngsutils.support.progress import default_progress
 
 
 class FASTARead(collections.namedtuple('FASTARecord', 'name comment seq')):
@@ -33,6 +33,17 @@ class FASTARead(collections.namedtuple('FASTARecord', 'name comment seq')):
 
 
 class FASTA(object):
+    '''
+    Reads FASTA (or qual) files. The file is read in large blocks, which are
+    split into records at each '>' at the start of a line. For most records
+    the sequence is then joined in one step; records with spaces, tabs or
+    comment lines (and qual files) are read line by line.
+
+    For random access to an uncompressed FASTA file with a .fai index, use
+    IndexedFASTA.
+    '''
+    _block_size = 4 * 1024 * 1024
+
     def __init__(self, fname=None, fileobj=None, qual=False):
         self.fname = fname
         self.qual = qual
@@ -61,16 +72,145 @@ class FASTA(object):
         self.fileobj.seek(pos, whence)
 
     def fetch(self, quiet=False):
-        name = ''
-        comment = ''
-        seq = ''
-
         if not quiet and self.fname and self.fname != '-':
-            eta = ETA(os.stat(self.fname).st_size, fileobj=self.fileobj)
+            progress = default_progress(os.stat(self.fname).st_size)
+            raw = getattr(self.fileobj, 'fileobj', None) or self.fileobj
+        else:
+            progress = None
+
+        parse_record = self._parse_record
+        first = True
+        for texts in self._record_texts():
+            for text in texts:
+                if first:
+                    # anything before the first '>' (usually nothing)
+                    first = False
+                    records = self._parse_lines(''.join(text))
+                else:
+                    records = parse_record(text)
+
+                for record in records:
+                    if progress:
+                        progress.update(1, raw.tell(), record.name)
+                    yield record
+
+        if progress:
+            progress.done()
+
+    def _record_texts(self):
+        '''
+        Yields lists of records, split at each '>' at the start of a line. The
+        text of each record starts after the '>'. Records that span more than
+        one block are lists of the pieces from each block. The first text is
+        whatever comes before the first record (usually nothing).
+        '''
+        pending = []
+        line_start = True
+
+        while True:
+            block = self.fileobj.read(FASTA._block_size)
+            if not block:
+                break
+
+            if line_start and block[0] == '>':
+                parts = [''] + block[1:].split('\n>')
+            else:
+                parts = block.split('\n>')
+            line_start = block[-1] == '\n'
+
+            pending.append(parts[0])
+            if len(parts) > 1:
+                parts[0] = pending
+                pending = [parts.pop()]
+                yield parts
+
+        yield [pending]
+
+    def _parse_record(self, text):
+        '''
+        Returns the records in a record text (from _record_texts). Usually one
+        record, but sequences with spaces or comments (and qual files) are read
+        line by line, so they may also have more records (or none).
+        '''
+        if type(text) is list:
+            if len(text) > 1:
+                return self._parse_pieces(text)
+            text = text[0]
+
+        if self.qual:
+            return self._parse_lines('>%s' % text)
+
+        idx = text.find('\n')
+        if idx == -1:
+            header = text
+            seq = ''
+        else:
+            header = text[:idx]
+            seq = text[idx + 1:].replace('\n', '')
+
+            if not seq.isalpha():
+                if '\r' in seq:
+                    seq = text[idx + 1:].replace('\r\n', '').replace('\n', '')
+                if not seq.isalpha():
+                    for char in _fasta_slow_chars:
+                        if char in seq:
+                            return self._parse_lines('>%s' % text)
+
+        header = header.rstrip()
+        if ' ' in header or '\t' in header:
+            name, comment = _fasta_header(header)
         else:
-            eta = None
+            name = header
+            comment = ''
 
-        for line in self.fileobj:
+        if name and seq:
+            return (FASTARead(name, comment, seq), )
+        return ()
+
+    def _parse_pieces(self, pieces):
+        '''
+        _parse_record for a long record. The new lines are removed from each
+        piece (in place, so the original piece can be freed), and then the
+        pieces are joined.
+        '''
+        idx = pieces[0].find('\n')
+        if self.qual or idx == -1:
+            return self._parse_record(''.join(pieces))
+
+        header = pieces[0][:idx]
+        pieces[0] = pieces[0][idx + 1:]
+        line_end = True
+
+        for i, piece in enumerate(pieces):
+            seq = piece.replace('\n', '')
+            if not seq.isalpha():
+                if '\r' in seq:
+                    piece = piece.replace('\r\n', '\n')
+                    seq = piece.replace('\n', '')
+                if not seq.isalpha():
+                    for char in _fasta_slow_chars:
+                        if char in seq:
+                            # read the rest line by line (the sequence so far
+                            # can be treated as one line)
+                            return self._parse_lines('>%s\n%s%s%s' % (header, ''.join(pieces[:i]), '\n' if line_end else '', ''.join(pieces[i:])))
+
+            if piece:
+                line_end = piece[-1] == '\n'
+            pieces[i] = seq
+
+        name, comment = _fasta_header(header.rstrip())
+        seq = ''.join(pieces)
+        if name and seq:
+            return (FASTARead(name, comment, seq), )
+        return ()
+
+    def _parse_lines(self, text):
+        name = ''
+        comment = ''
+        lines = []
+        records = []
+
+        for line in text.split('\n'):
             line = line.strip()
             if not line:
                 continue
@@ -78,109 +218,277 @@ class FASTA(object):
                 continue
 
             if line[0] == '>':
-                if name and seq:
-                    if eta:
-                        eta.print_status(extra=name)
-                    yield FASTARead(name, comment, seq)
-
-                spl = re.split(r'[ \t]', line[1:], maxsplit=1)
-                name = spl[0]
-                if len(spl) > 1:
-                    comment = spl[1]
-                else:
-                    comment = ''
-                seq = ''
-
+                if name and lines:
+                    records.append(FASTARead(name, comment, self._join(lines)))
+                name, comment = _fasta_header(line[1:])
+                lines = []
             else:
-                if self.qual:
-                    seq = seq + ' ' + line
-                else:
-                    seq += line
+                lines.append(line)
+
+        if name and lines:
+            records.append(FASTARead(name, comment, self._join(lines)))
+
+        return records
+
+    def _join(self, lines):
+        if self.qual:
+            return ' %s' % ' '.join(lines)
+        return ''.join(lines)
 
-        if name and seq:
-            if eta:
-                eta.print_status(extra=name)
-            yield FASTARead(name, comment, seq)
 
-        if eta:
-            eta.done()
+# any of these in a sequence means it has to be read line by line
+_fasta_slow_chars = ' \t#\r\x0b\x0c'
 
 
-def gzip_reader(fname, quiet=False, callback=None, done_callback=None, fileobj=None):
+def _fasta_header(header):
+    '''
+    Splits a header (without the '>') into the name and comment
+
+    >>> _fasta_header('chr1')
+    ('chr1', '')
+    >>> _fasta_header('chr1 a comment')
+    ('chr1', 'a comment')
+    '''
+    idx = header.find(' ')
+    tab = header.find('\t')
+    if tab != -1 and (idx == -1 or tab < idx):
+        idx = tab
+
+    if idx == -1:
+        return header, ''
+    return header[:idx], header[idx + 1:]
+
+
+class IndexedFASTA(object):
+    '''
+    Random access to an uncompressed FASTA file, using its .fai index
+    (samtools faidx). The file is memory mapped, so fetch() only reads the
+    lines that are needed. The interface is the same as pysam.Fastafile, so
+    this can also be used with ngsutils.bam.RefWindowCache.
+    '''
+    def __init__(self, fname):
+        self.filename = fname
+        self.references = []
+        self.lengths = []
+        self._index = {}
+
+        if fname[-3:] == '.gz' or fname[-4:] == '.bgz':
+            raise ValueError("Compressed FASTA files can't be indexed: %s" % fname)
+        if not os.path.exists('%s.fai' % fname):
+            raise ValueError("Missing FASTA index (samtools faidx): %s.fai" % fname)
+
+        with open('%s.fai' % fname) as f:
+            for line in f:
+                cols = line.rstrip('\n').split('\t')
+                if len(cols) < 5:
+                    continue
+                length, offset, linebases, linewidth = [int(x) for x in cols[1:5]]
+                self.references.append(cols[0])
+                self.lengths.append(length)
+                self._index[cols[0]] = (length, offset, linebases, linewidth)
+
+        self._fileobj = open(fname, 'rb')
+        self._mmap = mmap.mmap(self._fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._mmap.close()
+        self._fileobj.close()
+
+    def get_reference_length(self, reference):
+        return self._index[reference][0]
+
+    def fetch(self, reference, start=None, end=None):
+        '''
+        Returns the sequence for reference:start-end (0-based, end exclusive).
+        Returns an empty string for a missing reference.
+        '''
+        if reference not in self._index:
+            return ''
+
+        length, offset, linebases, linewidth = self._index[reference]
+        if start is None or start < 0:
+            start = 0
+        if end is None or end > length:
+            end = length
+        if start >= end:
+            return ''
+
+        first = offset + (start / linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) / linebases) * linewidth + (end - 1) % linebases
+
+        seq = self._mmap[first:last + 1]
+        if linewidth > linebases:
+            seq = seq.replace('\r', '').replace('\n', '')
+        return seq
+
+    def fetch_revcomp(self, reference, start=None, end=None, chunk_size=1048576):
+        '''
+        Yields the reverse complement of reference:start-end in chunks (see
+        revcomp_chunks), read directly from the file.
+        '''
+        if reference not in self._index:
+            return
+
+        length, offset, linebases, linewidth = self._index[reference]
+        if start is None or start < 0:
+            start = 0
+        if end is None or end > length:
+            end = length
+        if start >= end:
+            return
+
+        first = offset + (start / linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) / linebases) * linewidth + (end - 1) % linebases
+
+        for chunk in revcomp_chunks(self._mmap, first, last + 1, chunk_size):
+            yield chunk
+
+
+def gzip_reader(fname, quiet=False, callback=None, done_callback=None, fileobj=None, progress=None):
+    '''
+    Iterates over the lines in a (gzip compressed) text file. BGZF files are
+    inflated in a thread pool (see ngsutils.support.bgzip.BGZFLineReader).
+    Progress is shown on the terminal (unless quiet) or reported to
+    {progress}, a ngsutils.support.progress.Progress object. The offset
+    reported is in the compressed file.
+    '''
     if fileobj:
         f = fileobj
     elif fname == '-':
         f = sys.stdin
     elif fname[-3:] == '.gz' or fname[-4:] == '.bgz':
-        f = gzip.open(os.path.expanduser(fname))
+        f = bgzf_aware_open(os.path.expanduser(fname))
     else:
         f = open(os.path.expanduser(fname))
 
-    if quiet or fname == '-':
-        eta = None
-    else:
-        eta = ETA(os.stat(fname).st_size, fileobj=f)
+    if progress is None and not quiet and fname != '-':
+        progress = default_progress(os.stat(fname).st_size)
+
+    if progress:
+        every = progress.every
+        countdown = every
+
+        # for gzip files, report the offset of the compressed file
+        raw = getattr(f, 'fileobj', None) or f
+
+        def offset():
+            try:
+                return raw.tell()
+            except (IOError, ValueError):
+                return None
 
     for line in f:
-        if eta:
-            if callback:
-                extra = callback()
-            else:
-                extra = ''
+        if progress:
+            countdown -= 1
+            if not countdown:
+                countdown = every
+                progress.update(every, offset(), callback or '')
 
-            eta.print_status(extra=extra)
         yield line
 
         if done_callback and done_callback():
                 break
 
+    if progress:
+        progress.done(every - countdown, offset())
+
     if f != sys.stdin:
         f.close()
 
-    if eta:
-        eta.done()
-
 
 class Symbolize(object):
-    'Converts strings to symbols - basically a cache of strings'
+    '''
+    Converts strings to symbols - basically a cache of strings
+
+    If maxsize is set, at most {maxsize} strings are kept, in two generations
+    (of maxsize/2). When the current generation is full, it replaces the old
+    generation. Strings found in the old generation are moved to the current
+    one, so the strings that are still being used stay cached.
+
+    >>> symbols = Symbolize(maxsize=4)
+    >>> chrom = symbols['chr1']
+    >>> symbols[''.join(['chr', '1'])] is chrom
+    True
+    >>> for i in xrange(100):
+    ...     sym = symbols['read%s' % i]
+    ...     sym = symbols['chr1']
+    >>> len(symbols) <= 4 and symbols['chr1'] is chrom
+    True
+    '''
 
-    def __init__(self):
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
         self.__cache = {}
+        self.__old = {}
+        self.__generation = max(maxsize / 2, 1) if maxsize else None
 
     def __getitem__(self, k):
-        if k not in self.__cache:
+        try:
+            return self.__cache[k]
+        except KeyError:
+            pass
+
+        if self.__generation is None:
             self.__cache[k] = k
+            return k
+
+        sym = self.__old.pop(k, k)
+        if len(self.__cache) >= self.__generation:
+            self.__old = self.__cache
+            self.__cache = {}
+        self.__cache[sym] = sym
+        return sym
+
+    def __len__(self):
+        return len(self.__cache) + len(self.__old)
 
-        return self.__cache[k]
 
 symbols = Symbolize()
 
-_compliments = {
-    'a': 't',
-    'A': 'T',
-    'c': 'g',
-    'C': 'G',
-    'g': 'c',
-    'G': 'C',
-    't': 'a',
-    'T': 'A',
-    'n': 'n',
-    'N': 'N'
-}
+# complements for the IUPAC nucleotide codes (other characters are kept as is)
+_complement_table = string.maketrans('ACGTUMRWSYKVHDBNacgtumrwsykvhdbn', 'TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn')
 
 
 def revcomp(seq):
     '''
     >>> revcomp('ATCGatcg')
     'cgatCGAT'
+    >>> revcomp('ACGTRYKMBDHVSWN')
+    'NWSBDHVKMRYACGT'
     '''
-    ret = []
+    return seq.translate(_complement_table)[::-1]
 
-    for s in seq:
-        ret.append(_compliments[s])
 
-    ret.reverse()
-    return ''.join(ret)
+def revcomp_chunks(src, start=0, end=None, chunk_size=1048576):
+    '''
+    Yields the reverse complement of src[start:end] in chunks, starting from
+    the end of src, so that a long sequence can be written out without
+    holding all of it (or its reverse complement) in memory. src can be a
+    str, an mmap, or a seekable file. Line breaks are removed.
+
+    >>> ''.join(revcomp_chunks('AACG\\nTTGC\\nA', chunk_size=3))
+    'TGCAACGTT'
+    '''
+    if isinstance(src, (str, mmap.mmap)):
+        if end is None:
+            end = len(src)
+
+        def read(s, e):
+            return src[s:e]
+    else:
+        if end is None:
+            src.seek(0, 2)
+            end = src.tell()
+
+        def read(s, e):
+            src.seek(s)
+            return src.read(e - s)
+
+    pos = end
+    while pos > start:
+        chunk_start = max(start, pos - chunk_size)
+        yield read(chunk_start, pos).translate(_complement_table, '\r\n')[::-1]
+        pos = chunk_start
 
 
 class Counts(object):
@@ -212,22 +520,146 @@ class Counts(object):
         return len(self.bins) - 1
 
 
-def memoize(func):
+MemoizeInfo = collections.namedtuple('MemoizeInfo', 'hits misses maxsize currsize')
+
+_memoized = []
+_memoize_kwargs = object()
+
+
+def memoize(func=None, maxsize=100000):
+    '''
+    Memoizing decorator. The last {maxsize} results are cached (LRU); set
+    maxsize to None for an unbounded cache. Can be used as @memoize or
+    @memoize(maxsize=N).
+
+    The decorated function has cache_info() (hits, misses, maxsize, currsize)
+    and cache_clear(). Calls with unhashable arguments aren't cached. If
+    TESTING or DEBUG is set, nothing is cached (but calls are still counted).
+
+    >>> @memoize(maxsize=2)
+    ... def square(x):
+    ...     return x * x
+    >>> [square(x) for x in (1, 2, 1, 3, 2)]
+    [1, 4, 1, 9, 4]
+    >>> square.cache_info()
+    MemoizeInfo(hits=1, misses=4, maxsize=2, currsize=2)
+    '''
+    if func is None:
+        return lambda func: memoize(func, maxsize)
+
     if 'TESTING' in os.environ or 'DEBUG' in os.environ:
-        return func
+        maxsize = 0
+
+    cache = {}
+    stats = [0, 0]  # hits, misses
+
+    # LRU order is kept in a circular doubly linked list of
+    # [prev, next, key, result] links, so hits and evictions are O(1)
+    root = []
+    root[:] = [root, root, None, None]
+
+    def make_key(args, kwargs):
+        if kwargs:
+            return args + (_memoize_kwargs,) + tuple(sorted(kwargs.iteritems()))
+        if len(args) == 1 and type(args[0]) in (int, long, str):
+            return args[0]
+        return args
+
+    def inner_unbounded(*args, **kwargs):
+        key = make_key(args, kwargs)
+        try:
+            result = cache[key]
+        except KeyError:
+            stats[1] += 1
+            result = cache[key] = func(*args, **kwargs)
+            return result
+        except TypeError:
+            # unhashable arguments
+            stats[1] += 1
+            return func(*args, **kwargs)
+        stats[0] += 1
+        return result
+
+    def inner_uncached(*args, **kwargs):
+        stats[1] += 1
+        return func(*args, **kwargs)
+
+    def inner_lru(*args, **kwargs):
+        key = make_key(args, kwargs)
+        try:
+            link = cache.get(key)
+        except TypeError:
+            stats[1] += 1
+            return func(*args, **kwargs)
+
+        if link is not None:
+            stats[0] += 1
+            prev_link, next_link, key, result = link
+            prev_link[1] = next_link
+            next_link[0] = prev_link
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return result
+
+        stats[1] += 1
+        result = func(*args, **kwargs)
+        if key in cache:
+            # added by a recursive call
+            return result
+
+        if len(cache) >= maxsize:
+            # reuse the oldest link for the new result
+            oldest = root[1]
+            del cache[oldest[2]]
+            oldest[2] = key
+            oldest[3] = result
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            last = root[0]
+            last[1] = root[0] = oldest
+            oldest[0] = last
+            oldest[1] = root
+            cache[key] = oldest
+        else:
+            last = root[0]
+            link = [last, root, key, result]
+            last[1] = root[0] = cache[key] = link
+        return result
+
+    if maxsize is None:
+        inner = inner_unbounded
+    elif maxsize <= 0:
+        inner = inner_uncached
+    else:
+        inner = inner_lru
 
-    __cache = {}
+    def cache_info():
+        return MemoizeInfo(stats[0], stats[1], maxsize, len(cache))
 
-    def inner(*args, **kwargs):
-        k = (args, tuple(kwargs.iteritems()))
-        if k not in __cache:
-            __cache[k] = func(*args, **kwargs)
-        return __cache[k]
+    def cache_clear():
+        cache.clear()
+        root[:] = [root, root, None, None]
+        stats[:] = [0, 0]
 
+    inner.cache_info = cache_info
+    inner.cache_clear = cache_clear
+    inner.__name__ = func.__name__
+    inner.__module__ = func.__module__
     inner.__doc__ = '(@memoized %s)\n%s' % (func.__name__, func.__doc__)
+    _memoized.append(inner)
     return inner
 
 
+def memoize_report(out=sys.stderr):
+    'Writes the cache_info() for each memoized function that was called'
+    for func in _memoized:
+        info = func.cache_info()
+        if info.hits or info.misses:
+            out.write('%s.%s: %s hits, %s misses, %s cached\n' % (func.__module__, func.__name__, info.hits, info.misses, info.currsize))
+
+
 def quoted_split(s, delim, quote_char='"'):
     tokens = []
 
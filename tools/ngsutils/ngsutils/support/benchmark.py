@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+'''
+Benchmarks for ngsutils.support.
+
+Usage: benchmark.py regions {-reads N} {-seed N} {genes.gtf}
+       benchmark.py revcomp {-size N} {-seed N}
+
+regions
+    Compares the original RegionTagger (one RangeMatch per feature type,
+    with 100kb bins that are scanned in order) with the current RegionTagger
+    (one merged RegionIndex). Reports the build time and the time to tag
+    each read, and checks that both taggers give each read the same tag.
+
+    If no GTF file is given (e.g. a full GENCODE annotation), a GENCODE-sized
+    set of synthetic genes is used (~60,000 genes, ~200,000 transcripts).
+
+revcomp
+    Compares the original revcomp (a dict lookup per base) with the current
+    one (str.translate), on a random sequence of {size} Mb (default: 50). Also
+    times reverse complementing the sequence from an indexed FASTA file, in
+    one piece (fetch + revcomp) and in chunks (fetch_revcomp).
+'''
+
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from ngsutils.support import IndexedFASTA, revcomp
+from ngsutils.support.regions import RegionTagger
+
+_chrom_sizes = [('chr%s' % (i + 1), size) for i, size in enumerate([
+    248956422, 242193529, 198295559, 190214555, 181538259, 170805979,
+    159345973, 145138636, 138394717, 133797422, 135086622, 133275309,
+    114364328, 107043718, 101991189, 90338345, 83257441, 80373285,
+    58617616, 64444167, 46709983, 50818468])]
+
+
+class Gene(object):
+    def __init__(self, chrom, strand):
+        self.chrom = chrom
+        self.strand = strand
+        self.transcripts = []
+
+    @property
+    def start(self):
+        return min([t.exons[0][0] for t in self.transcripts])
+
+    @property
+    def end(self):
+        return max([t.exons[-1][1] for t in self.transcripts])
+
+
+class Transcript(object):
+    def __init__(self, strand, exons, cds_start=None, cds_end=None):
+        '''
+        exons are sorted (start, end) tuples. The CDS is given by its genomic
+        start and end.
+        '''
+        self.exons = exons
+        self.cds = []
+        self.utr_5 = []
+        self.utr_3 = []
+        self.has_cds = cds_start is not None
+
+        if not self.has_cds:
+            return
+
+        before = []
+        after = []
+        for start, end in exons:
+            if start < cds_start:
+                before.append((start, min(end, cds_start)))
+            if end > cds_end:
+                after.append((max(start, cds_end), end))
+            if start < cds_end and end > cds_start:
+                self.cds.append((max(start, cds_start), min(end, cds_end)))
+
+        if strand == '+':
+            self.utr_5, self.utr_3 = before, after
+        else:
+            self.utr_5, self.utr_3 = after, before
+
+
+class GeneModels(object):
+    def __init__(self, genes):
+        self.genes = genes
+
+
+def gtf_genes(fname):
+    'Loads the genes from a GTF file (exon and CDS features only)'
+    transcripts = {}
+    genes = {}
+    f = gzip.open(fname) if fname[-3:] == '.gz' else open(fname)
+    for line in f:
+        if line[0] == '#':
+            continue
+        cols = line.rstrip('\n').split('\t')
+        if len(cols) < 9 or cols[2] not in ('exon', 'CDS'):
+            continue
+
+        attrs = {}
+        for attr in cols[8].split(';'):
+            attr = attr.strip().split(' ', 1)
+            if len(attr) == 2:
+                attrs[attr[0]] = attr[1].strip('"')
+
+        gene_id = attrs['gene_id']
+        transcript_id = attrs.get('transcript_id', gene_id)
+        if gene_id not in genes:
+            genes[gene_id] = (cols[0], cols[6], [])
+        if transcript_id not in transcripts:
+            transcripts[transcript_id] = ([], [])
+            genes[gene_id][2].append(transcript_id)
+
+        exons, cds = transcripts[transcript_id]
+        if cols[2] == 'exon':
+            exons.append((int(cols[3]) - 1, int(cols[4])))
+        else:
+            cds.append((int(cols[3]) - 1, int(cols[4])))
+    f.close()
+
+    out = []
+    for chrom, strand, transcript_ids in genes.itervalues():
+        gene = Gene(chrom, strand)
+        for transcript_id in transcript_ids:
+            exons, cds = transcripts[transcript_id]
+            if not exons:
+                continue
+            exons.sort()
+            if cds:
+                gene.transcripts.append(Transcript(strand, exons, min([s for s, e in cds]), max([e for s, e in cds])))
+            else:
+                gene.transcripts.append(Transcript(strand, exons))
+        if gene.transcripts:
+            out.append(gene)
+
+    out.sort(key=lambda gene: (gene.chrom, gene.start))
+    return GeneModels(out)
+
+
+def synthetic_genes(count=60000, seed=1):
+    '''
+    Random genes spread over the human-sized chromosomes, with 1-8 (mostly
+    coding) transcripts, each using some of the gene's 1-20 exons.
+    '''
+    rand = random.Random(seed)
+    genome_size = sum([size for chrom, size in _chrom_sizes])
+
+    genes = []
+    for chrom, size in _chrom_sizes:
+        for i in xrange(count * size / genome_size):
+            strand = rand.choice('+-')
+            gene = Gene(chrom, strand)
+            gene_start = rand.randint(5000, size - 500000)
+            gene_len = rand.randint(5000, 200000)
+            exon_starts = sorted(rand.sample(xrange(gene_start, gene_start + gene_len, 100), rand.randint(1, 20)))
+            gene_exons = [(start, start + rand.randint(50, 300)) for start in exon_starts]
+
+            for j in xrange(rand.randint(1, 8)):
+                exons = [exon for exon in gene_exons if rand.random() < 0.8] or gene_exons[:1]
+
+                if rand.random() < 0.75:
+                    cds_start = rand.randint(exons[0][0], exons[0][1])
+                    cds_end = rand.randint(exons[-1][0], exons[-1][1])
+                    if cds_end > cds_start:
+                        gene.transcripts.append(Transcript(strand, exons, cds_start, cds_end))
+                        continue
+                gene.transcripts.append(Transcript(strand, exons))
+
+            genes.append(gene)
+
+    return GeneModels(genes)
+
+
+class Read(object):
+    __slots__ = ('pos', 'is_reverse', 'cigar', 'is_unmapped', 'is_paired', 'is_read1')
+
+    def __init__(self, pos, is_reverse, cigar):
+        self.pos = pos
+        self.is_reverse = is_reverse
+        self.cigar = cigar
+        self.is_unmapped = False
+        self.is_paired = False
+        self.is_read1 = True
+
+
+def random_reads(gtf, count, seed=1):
+    '''
+    Returns (chrom, read) for {count} reads: half in (or near) exons, and
+    half at random positions in the genome.
+    '''
+    rand = random.Random(seed)
+    exons = []
+    for gene in gtf.genes:
+        for transcript in gene.transcripts:
+            for start, end in transcript.exons:
+                exons.append((gene.chrom, start, end))
+
+    reads = []
+    for i in xrange(count):
+        if exons and i % 2 == 0:
+            chrom, start, end = rand.choice(exons)
+            pos = rand.randint(start - 100, end + 100)
+        else:
+            chrom, size = rand.choice(_chrom_sizes)
+            pos = rand.randint(0, size)
+
+        cigar = [(0, 100)] if rand.random() < 0.9 else [(0, 50), (3, 500), (0, 50)]
+        reads.append((chrom, Read(pos, rand.random() < 0.5, cigar)))
+
+    return reads
+
+
+class OrigRangeMatch(object):
+    'The original RangeMatch (the most recently added range is first in each bin)'
+    def __init__(self, name):
+        self.ranges = {}
+        self.name = name
+
+    def add_range(self, chrom, strand, start, end):
+        if chrom not in self.ranges:
+            self.ranges[chrom] = {}
+
+        for bin in xrange(start / 100000, (end / 100000) + 1):
+            if bin not in self.ranges[chrom]:
+                self.ranges[chrom][bin] = []
+            self.ranges[chrom][bin].insert(0, (start, end, strand))
+
+    def get_tag(self, chrom, strand, pos):
+        if chrom not in self.ranges:
+            return None, False
+        bin = pos / 100000
+        if bin not in self.ranges[chrom]:
+            return None, False
+        for start, end, r_strand in self.ranges[chrom][bin]:
+            if pos >= start and pos <= end:
+                if strand == r_strand:
+                    return self.name, False
+                return self.name, True
+        return None, False
+
+
+class OrigRegionTagger(RegionTagger):
+    'The original RegionTagger: a RangeMatch for each feature type'
+    def __init__(self, gtf, only_first_fragment=True):
+        self.counts = dict([(name, 0) for name in ['junction', 'intergenic', 'mitochondrial']])
+        self.only_first_fragment = only_first_fragment
+
+        matches = dict([(name, OrigRangeMatch(name)) for name in RegionTagger._priorities])
+        for name in RegionTagger._priorities:
+            self.counts[name] = 0
+            self.counts['%s-rev' % name] = 0
+
+        for gene in gtf.genes:
+            if gene.strand == '+':
+                matches['promoter'].add_range(gene.chrom, gene.strand, gene.start - 2000, gene.start)
+            else:
+                matches['promoter'].add_range(gene.chrom, gene.strand, gene.end, gene.end + 2000)
+
+            for transcript in gene.transcripts:
+                if transcript.has_cds:
+                    for start, end in transcript.cds:
+                        matches['coding'].add_range(gene.chrom, gene.strand, start, end)
+                    for s, e in transcript.utr_5:
+                        matches['utr-5'].add_range(gene.chrom, gene.strand, s, e)
+                    for s, e in transcript.utr_3:
+                        matches['utr-3'].add_range(gene.chrom, gene.strand, s, e)
+
+                last_end = None
+                for start, end in transcript.exons:
+                    if last_end:
+                        matches['intron'].add_range(gene.chrom, gene.strand, last_end, start)
+                    matches['other-exon'].add_range(gene.chrom, gene.strand, start, end)
+                    last_end = end
+
+        self.regions = [matches[name] for name in RegionTagger._priorities]
+
+    def _get_tag(self, chrom, strand, pos):
+        for region in self.regions:
+            tag, is_rev = region.get_tag(chrom, strand, pos)
+            if tag:
+                return tag, is_rev
+        return None, False
+
+
+def benchmark_regions(name, gtf, reads, out=sys.stdout):
+    out.write('%s: %s genes, %s reads\n' % (name, len(gtf.genes), len(reads)))
+
+    results = []
+    for tagger_class in [OrigRegionTagger, RegionTagger]:
+        start = time.time()
+        tagger = tagger_class(gtf)
+        build = time.time() - start
+
+        start = time.time()
+        tags = []
+        for chrom, read in reads:
+            tags.append(tagger.add_read(read, chrom))
+        elapsed = time.time() - start
+
+        out.write('    %-16s build: %8.3fs    tag: %8.3fs (%.2f us/read)\n' % (tagger_class.__name__, build, elapsed, elapsed * 1000000 / len(reads)))
+        results.append((tags, tagger.counts))
+        tagger = None
+
+    if results[0] != results[1]:
+        out.write('    ERROR: taggers returned different tags!\n')
+
+
+_orig_compliments = {'a': 't', 'A': 'T', 'c': 'g', 'C': 'G', 'g': 'c', 'G': 'C', 't': 'a', 'T': 'A', 'n': 'n', 'N': 'N'}
+
+
+def orig_revcomp(seq):
+    'The original revcomp (a dict lookup for each base)'
+    ret = []
+
+    for s in seq:
+        ret.append(_orig_compliments[s])
+
+    ret.reverse()
+    return ''.join(ret)
+
+
+def benchmark_revcomp(size, seed=1, out=sys.stdout):
+    rand = random.Random(seed)
+    unit = ''.join([rand.choice('ACGTacgtN') for i in xrange(1000000)])
+    seq = unit * size
+    mb = float(len(seq)) / 1000000
+    out.write('revcomp: %s Mb\n' % size)
+
+    results = []
+    for func in [orig_revcomp, revcomp]:
+        start = time.time()
+        results.append(func(seq))
+        elapsed = time.time() - start
+        out.write('    %-16s %8.3fs (%.1f Mb/s)\n' % (func.__name__, elapsed, mb / elapsed))
+
+    if results[0] != results[1]:
+        out.write('    ERROR: revcomp functions returned different sequences!\n')
+    results = None
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'seq.fa')
+        with open(fname, 'w') as f:
+            f.write('>seq\n')
+            for i in xrange(0, len(seq), 60):
+                f.write('%s\n' % seq[i:i + 60])
+        with open('%s.fai' % fname, 'w') as f:
+            f.write('seq\t%s\t5\t60\t61\n' % len(seq))
+
+        expected = revcomp(seq)
+        seq = None
+        fasta = IndexedFASTA(fname)
+
+        start = time.time()
+        whole = revcomp(fasta.fetch('seq'))
+        elapsed = time.time() - start
+        out.write('    %-16s %8.3fs (%.1f Mb/s)\n' % ('fetch+revcomp', elapsed, mb / elapsed))
+        match = whole == expected
+        whole = None
+
+        start = time.time()
+        chunks = []
+        for chunk in fasta.fetch_revcomp('seq'):
+            chunks.append(chunk)
+        elapsed = time.time() - start
+        out.write('    %-16s %8.3fs (%.1f Mb/s)\n' % ('fetch_revcomp', elapsed, mb / elapsed))
+
+        if not match or ''.join(chunks) != expected:
+            out.write('    ERROR: FASTA reverse complement is wrong!\n')
+        fasta.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    args = []
+    num_reads = 1000000
+    size = 50
+    seed = 1
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-reads':
+            num_reads = int(arg)
+            last = None
+        elif last == '-size':
+            size = int(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif arg in ['-reads', '-size', '-seed']:
+            last = arg
+        elif arg == '-h':
+            print __doc__
+            sys.exit(1)
+        else:
+            args.append(arg)
+
+    if args == ['revcomp']:
+        benchmark_revcomp(size, seed=seed)
+        sys.exit(0)
+
+    if not args or args[0] != 'regions' or len(args) > 2:
+        print __doc__
+        sys.exit(1)
+
+    if len(args) == 2:
+        gtf = gtf_genes(args[1])
+        name = args[1]
+    else:
+        gtf = synthetic_genes(seed=seed)
+        name = 'synthetic'
+
+    benchmark_regions(name, gtf, random_reads(gtf, num_reads, seed=seed))
@@ -4,78 +4,373 @@ Extract the blocks from a BGZip file.
 
 BAM files are stored as blocks in a bgzip archive. This class
 will load the bgzip archive and output the block information.
+
+BGZFLineReader reads the lines from a BGZF file (bgzip, tabix), inflating
+the blocks in a thread pool. Use bgzf_aware_open() to open a gzip file with
+it if it is BGZF (and with the gzip module if not).
 '''
 
+import bisect
+import collections
+import cStringIO
+import gzip
+import multiprocessing
+import multiprocessing.pool
 import os
 import struct
 import sys
+import zlib
+
+_bgzf_magic = '\x1f\x8b\x08\x04'
+
+
+def is_bgzf(fname):
+    '''
+    Returns True if the file starts with a BGZF block (a gzip member with a
+    'BC' extra subfield)
+    '''
+    with open(fname, 'rb') as f:
+        try:
+            return read_block(f) is not None
+        except ValueError:
+            return False
+
+
+def read_block(fileobj):
+    '''
+    Reads the next BGZF block from a file. Returns (compressed data, size of
+    the inflated data), or None at the end of the file. Raises ValueError if
+    this isn't a BGZF block.
+    '''
+    header = fileobj.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != _bgzf_magic:
+        raise ValueError('Not a BGZF block')
+
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = fileobj.read(xlen)
+
+    bsize = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = struct.unpack('<BBH', extra[pos:pos + 4])
+        if si1 == 66 and si2 == 67 and slen == 2:
+            bsize, = struct.unpack('<H', extra[pos + 4:pos + 6])
+        pos += 4 + slen
+
+    if bsize is None:
+        raise ValueError('Not a BGZF block (missing BC subfield)')
+
+    rest = fileobj.read(bsize + 1 - 12 - xlen)
+    if len(rest) < 8:
+        raise ValueError('Truncated BGZF block')
+
+    isize, = struct.unpack('<I', rest[-4:])
+    return rest[:-8], isize
+
+
+def inflate_block(cdata, isize):
+    data = zlib.decompress(cdata, -15)
+    if len(data) != isize:
+        raise ValueError('Corrupt BGZF block (expected %s bytes, got %s)' % (isize, len(data)))
+    return data
+
+
+def _inflate_lines(blocks):
+    'Inflates a list of blocks, and splits them into lines (keeping the ends)'
+    data = ''.join([inflate_block(cdata, isize) for cdata, isize in blocks])
+    return cStringIO.StringIO(data).readlines()
+
+
+class BGZFLineReader(object):
+    '''
+    Reads the lines from a BGZF file. The blocks are read in batches of
+    {batch_blocks} and inflated in a pool of {threads} threads (zlib releases
+    the GIL), up to {depth} batches ahead of the lines being returned. The
+    lines are returned in order (with their line endings, like a file).
+    '''
+    def __init__(self, fname, threads=None, depth=None, batch_blocks=16):
+        self.fname = fname
+        self.fileobj = open(fname, 'rb')
+        self.threads = threads or min(4, multiprocessing.cpu_count())
+        self.depth = depth or self.threads * 2
+        self.batch_blocks = batch_blocks
+        self._pool = None
+        self._lines = None
+
+    def __iter__(self):
+        if self._lines is None:
+            self._lines = self._iter_lines()
+        return self._lines
+
+    def _iter_lines(self):
+        for lines in self.batches():
+            for line in lines:
+                yield line
+
+    def readline(self):
+        return next(iter(self), '')
+
+    def close(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+        self.fileobj.close()
+
+    def _next_blocks(self):
+        blocks = []
+        while len(blocks) < self.batch_blocks:
+            block = read_block(self.fileobj)
+            if block is None:
+                break
+            blocks.append(block)
+        return blocks
+
+    def batches(self):
+        'Yields lists of lines, in order'
+        if self.threads > 1:
+            self._pool = multiprocessing.pool.ThreadPool(self.threads)
+
+        pending = collections.deque()
+        carry = ''
+        eof = False
+
+        try:
+            while True:
+                while not eof and len(pending) < self.depth:
+                    blocks = self._next_blocks()
+                    if not blocks:
+                        eof = True
+                    elif self._pool:
+                        pending.append(self._pool.apply_async(_inflate_lines, (blocks, )))
+                    else:
+                        pending.append(_inflate_lines(blocks))
+
+                if not pending:
+                    break
+
+                lines = pending.popleft()
+                if self._pool:
+                    lines = lines.get()
+
+                if not lines:
+                    continue
+                if carry:
+                    lines[0] = carry + lines[0]
+                    carry = ''
+                if lines[-1][-1] != '\n':
+                    carry = lines.pop()
+                if lines:
+                    yield lines
+
+            if carry:
+                yield [carry]
+
+        finally:
+            if self._pool:
+                self._pool.terminate()
+                self._pool = None
+
+
+def bgzf_aware_open(fname, threads=None, depth=None):
+    '''
+    Opens a gzip compressed text file for reading lines. BGZF files are read
+    with a BGZFLineReader, other gzip files with the gzip module.
+    '''
+    if is_bgzf(fname):
+        return BGZFLineReader(fname, threads=threads, depth=depth)
+    return gzip.open(fname)
 
 
 class BGZip(object):
-    def __init__(self, fname):
+    '''
+    Random access to a BGZF file.
+
+    seek()/tell() use virtual offsets (the offset of the block in the file
+    << 16 | the offset in the inflated block), like the offsets in BAM and
+    tabix indexes. useek()/utell() use offsets in the uncompressed data,
+    using a .gzi index of the blocks (bgzip -i), which is loaded if it exists,
+    and built (by reading the block headers) if not.
+
+    Blocks are only inflated when they are read, and the last {cache_size}
+    inflated blocks are kept.
+    '''
+    def __init__(self, fname, cache_size=16):
         self.fname = fname
         self.pos = 0
-        self.fileobj = open(self.fname)
+        self.fileobj = open(self.fname, 'rb')
         self.fsize = os.stat(self.fname).st_size
-        self.cur_chunk = 0
+        self.cache_size = cache_size
+
+        self._cache = collections.OrderedDict()  # block offset -> (data, next block offset)
+        self._block = 0  # offset of the current block
+        self._block_end = 0  # offset of the next block
+        self._data = ''
+        self._within = 0  # position in the current (inflated) block
+
+        self._coffsets = None
+        self._uoffsets = None
 
-        self.cpos = 0
-        self.cdata = 0
+        self._load_block(0)
 
     def close(self):
         self.fileobj.close()
 
+    def _load_block(self, offset):
+        '''
+        Makes the block at {offset} the current block. Returns False if offset
+        is the end of the file.
+        '''
+        if offset in self._cache:
+            data, block_end = self._cache.pop(offset)
+        else:
+            self.fileobj.seek(offset)
+            block = read_block(self.fileobj)
+            if block is None:
+                return False
+            data = inflate_block(*block)
+            block_end = self.fileobj.tell()
+
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+
+        self._cache[offset] = (data, block_end)
+        self._block = offset
+        self._block_end = block_end
+        self._data = data
+        self._within = 0
+        return True
+
+    def tell(self):
+        'Returns the current virtual offset'
+        return (self._block << 16) | self._within
+
     def seek(self, offset):
-        bgz_offset = offset >> 16
-        chunk_offset = offset & 0xFFFF
-
-        self.fileobj.seek(bgz_offset)
-        self.read_chunk()
-        self.chunk_pos = chunk_offset
-
-    def read(self, amount, whence=0):
-        if whence not in [0, 1]:
-            print "Bad Whence value!: %s" % whence
-            return
-
-        if whence == 0:
-            self.seek(0, 0)
-
-        # read into chunk, if not enough data in chunk, read next chunk
-        ret = ''
-        while amount and self.pos < self.fsize:
-            if len(self.cdata) - self.cpos < amount:
-                ret += self.cdata[self.cpos:self.cpos + amount]
-                self.cpos += amount
-                return ret
+        'Seeks to a virtual offset'
+        block = offset >> 16
+        within = offset & 0xFFFF
+
+        if block != self._block or not self._data:
+            if not self._load_block(block):
+                self._data = ''
+                self._block = self._block_end = block
+
+        if within > len(self._data):
+            raise ValueError("Invalid virtual offset: %s (block %s is only %s bytes)" % (offset, block, len(self._data)))
+        self._within = within
+
+    def read(self, amount=-1):
+        '''
+        Reads {amount} bytes (or the rest of the file) from the current
+        position
+        '''
+        ret = []
+        while amount != 0:
+            if self._within >= len(self._data):
+                if not self._load_block(self._block_end):
+                    break
+                continue
+
+            if amount < 0:
+                chunk = self._data[self._within:]
             else:
-                ret += self.cdata[self.cpos:]
-                amount = amount - len(ret)
-                self.read_chunk()
-        return ret
-
-    def read_chunk(self):
-        self.fileobj.seek(10)
-        id1, id2, cm, flg, mtime, xfl, os, xlen = self._read_fields('<BBBBIBBH')
-        subpos = 0
-        bsize = 0
-
-        while subpos < xlen:
-            si1, si2, slen = self._read_fields('<BBH')
-            if si1 == 66 and si2 == 67:
-                bsize, = self._read_fields('<H')
+                chunk = self._data[self._within:self._within + amount]
+                amount -= len(chunk)
+
+            self._within += len(chunk)
+            ret.append(chunk)
+
+        return ''.join(ret)
+
+    def readline(self):
+        ret = []
+        while True:
+            if self._within >= len(self._data):
+                if not self._load_block(self._block_end):
+                    break
+                continue
+
+            idx = self._data.find('\n', self._within)
+            if idx == -1:
+                ret.append(self._data[self._within:])
+                self._within = len(self._data)
             else:
-                self.fileobj.seek(slen, 1)
-                self.pos += slen
+                ret.append(self._data[self._within:idx + 1])
+                self._within = idx + 1
+                break
+
+        return ''.join(ret)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def _block_index(self):
+        if self._coffsets is None:
+            if os.path.exists('%s.gzi' % self.fname):
+                self.load_index()
+            else:
+                self.build_index()
+        return self._coffsets, self._uoffsets
+
+    def build_index(self):
+        '''
+        Builds the index of (compressed, uncompressed) offsets of each block
+        from the block headers (without inflating them)
+        '''
+        coffsets = []
+        uoffsets = []
+        upos = 0
+
+        with open(self.fname, 'rb') as f:
+            while True:
+                offset = f.tell()
+                block = read_block(f)
+                if block is None:
+                    break
+                coffsets.append(offset)
+                uoffsets.append(upos)
+                upos += block[1]
+
+        self._coffsets = coffsets
+        self._uoffsets = uoffsets
+
+    def load_index(self, fname=None):
+        '''
+        Loads a .gzi index: the number of entries, then the (compressed,
+        uncompressed) offsets for each block after the first (all uint64)
+        '''
+        with open(fname or '%s.gzi' % self.fname, 'rb') as f:
+            count, = struct.unpack('<Q', f.read(8))
+            values = struct.unpack('<%sQ' % (count * 2), f.read(count * 16))
+
+        self._coffsets = [0] + list(values[0::2])
+        self._uoffsets = [0] + list(values[1::2])
+
+    def write_index(self, fname=None):
+        'Writes the block index as a .gzi file'
+        coffsets, uoffsets = self._block_index()
 
-            subpos += 6 + slen
+        # the first block (0, 0) isn't stored
+        with open(fname or '%s.gzi' % self.fname, 'wb') as f:
+            f.write(struct.pack('<Q', len(coffsets) - 1))
+            for c, u in zip(coffsets, uoffsets)[1:]:
+                f.write(struct.pack('<QQ', c, u))
 
-        cdata_size = bsize - xlen - 19
-        self.cdata = self.fileobj.read(cdata_size)  # inflate value
-        self.fileobj.seek(8)
+    def utell(self):
+        'Returns the current offset in the uncompressed data'
+        coffsets, uoffsets = self._block_index()
+        return uoffsets[bisect.bisect_left(coffsets, self._block)] + self._within
 
-        self.cur_chunk += 1
-        self.cpos = 0
+    def useek(self, pos):
+        'Seeks to an offset in the uncompressed data'
+        coffsets, uoffsets = self._block_index()
+        i = bisect.bisect_right(uoffsets, pos) - 1
+        self.seek((coffsets[i] << 16) | (pos - uoffsets[i]))
 
     def dump(self):
         self.fileobj.seek(0)
@@ -2,6 +2,8 @@
 Support package for processing a dbSNP tabix dump from UCSC.
 '''
 
+import array
+import bisect
 import collections
 import sys
 
@@ -76,10 +78,31 @@ def autotype(ar, length=26):
     return out
 
 
+DBSNPCacheInfo = collections.namedtuple('DBSNPCacheInfo', 'hits misses window currsize')
+
+
 class DBSNP(object):
-    def __init__(self, fname):
+    '''
+    Looks up dbSNP records by position.
+
+    When window is set, records are fetched a window at a time (one tabix
+    query per window of {window} bases) and kept in a position index. This
+    is much faster than querying tabix for each position when the reads are
+    sorted. The last {max_windows} windows are kept; older windows are
+    evicted as the reads move along the genome. Set window to 0 to query
+    tabix for each position.
+
+    cache_info() returns the number of lookups that were found in a cached
+    window (hits) and the number that needed a new tabix query (misses).
+    '''
+    def __init__(self, fname, window=10000, max_windows=2):
         self.dbsnp = pysam.Tabixfile(fname)
         self.asTup = pysam.asTuple()
+        self.window = window
+        self.max_windows = max_windows
+        self.hits = 0
+        self.misses = 0
+        self._windows = []  # (chrom, start, positions, records), most recent first
 
     def fetch(self, chrom, pos):
         'Note: pos is 0-based'
@@ -87,10 +110,54 @@ class DBSNP(object):
         # Note: tabix the command uses 1-based positions, but
         #       pysam.Tabixfile uses 0-based positions
 
-        for tup in self.dbsnp.fetch(chrom, pos, pos + 1, parser=self.asTup):
-            snp = SNPRecord._make(autotype(tup))
-            if snp.chromStart == pos:
-                yield snp
+        if not self.window:
+            for tup in self.dbsnp.fetch(chrom, pos, pos + 1, parser=self.asTup):
+                snp = SNPRecord._make(autotype(tup))
+                if snp.chromStart == pos:
+                    yield snp
+            return
+
+        positions, records = self._fetch_window(chrom, pos)
+
+        i = bisect.bisect_left(positions, pos)
+        while i < len(positions) and positions[i] == pos:
+            snp = records[i]
+            if not isinstance(snp, SNPRecord):
+                # records are parsed the first time they are used
+                snp = records[i] = SNPRecord._make(autotype(snp))
+            yield snp
+            i += 1
+
+    def _fetch_window(self, chrom, pos):
+        start = pos - (pos % self.window)
+
+        for i, (wchrom, wstart, positions, records) in enumerate(self._windows):
+            if wstart == start and wchrom == chrom:
+                self.hits += 1
+                if i:
+                    self._windows.insert(0, self._windows.pop(i))
+                return positions, records
+
+        self.misses += 1
+        positions = array.array('l')
+        records = []
+
+        for tup in self.dbsnp.fetch(chrom, start, start + self.window, parser=self.asTup):
+            snpstart = int(tup[2])
+
+            # only keep records that a single position query would return
+            # (zero-length records, insertions, never overlap a position)
+            if start <= snpstart < start + self.window and int(tup[3]) > snpstart:
+                positions.append(snpstart)
+                records.append(tup)
+
+        self._windows.insert(0, (chrom, start, positions, records))
+        del self._windows[self.max_windows:]
+
+        return positions, records
+
+    def cache_info(self):
+        return DBSNPCacheInfo(self.hits, self.misses, self.window, len(self._windows))
 
     def close(self):
         self.dbsnp.close()
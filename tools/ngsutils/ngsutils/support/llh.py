@@ -6,6 +6,11 @@ import math
 
 from ngsutils.support import memoize
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _default_background = {'A': 0.3, 'T': 0.3, 'C': 0.2, 'G': 0.2}
 
 NucleotideLogLikelihood = collections.namedtuple('NucleotideLogLikelihood', 'A C G T pseudo')
@@ -15,9 +20,9 @@ NucleotideLogLikelihood = collections.namedtuple('NucleotideLogLikelihood', 'A C
 def pseudo_count(N, bg):
     '''
     >>> pseudo_count(100, _default_background['A'])
-    3
+    3.0
     >>> pseudo_count(100, _default_background['C'])
-    2
+    2.0
     '''
 
     return bg * math.sqrt(N)
@@ -51,6 +56,44 @@ def calc_llh(A, C, G, T, bg=_default_background, pseudo='auto'):
     return NucleotideLogLikelihood(math.log(freqA / bg['A']), math.log(freqC / bg['C']), math.log(freqG / bg['G']), math.log(freqT / bg['T']), pseudo)
 
 
+def calc_llh_array(A, C, G, T, bg=_default_background, pseudo='auto'):
+    '''
+    calc_llh for arrays of A, C, G, T counts (one value per position), in one
+    call. Returns a NucleotideLogLikelihood of arrays. Without a pseudo count,
+    a zero count gives -inf (instead of a ValueError).
+
+    >>> llh = calc_llh_array([10, 0], [0, 5], [3, 5], [1, 0])
+    >>> numpy.allclose(llh.A, [calc_llh(10, 0, 3, 1).A, calc_llh(0, 5, 5, 0).A])
+    True
+    >>> numpy.allclose(llh.T, [calc_llh(10, 0, 3, 1).T, calc_llh(0, 5, 5, 0).T])
+    True
+    '''
+    if numpy is None:
+        raise ImportError('numpy is required for calc_llh_array')
+
+    Ap = numpy.array(A, dtype=numpy.float64)
+    Cp = numpy.array(C, dtype=numpy.float64)
+    Gp = numpy.array(G, dtype=numpy.float64)
+    Tp = numpy.array(T, dtype=numpy.float64)
+
+    if pseudo == 'auto':
+        sqrtN = numpy.sqrt(Ap + Cp + Gp + Tp)
+        Ap += bg['A'] * sqrtN
+        Cp += bg['C'] * sqrtN
+        Gp += bg['G'] * sqrtN
+        Tp += bg['T'] * sqrtN
+    elif pseudo:
+        Ap += pseudo
+        Cp += pseudo
+        Gp += pseudo
+        Tp += pseudo
+
+    Np = Ap + Cp + Gp + Tp
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return NucleotideLogLikelihood(numpy.log(Ap / Np / bg['A']), numpy.log(Cp / Np / bg['C']), numpy.log(Gp / Np / bg['G']), numpy.log(Tp / Np / bg['T']), pseudo)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -2,11 +2,14 @@
 """
 Common util classes / functions for the NGS project
 """
-import collections
-import gzip
+import heapq
 import os
 import re
 import sys
+import tempfile
+
+import ngsutils.support.bgzip
+from ngsutils.support import memoize  # noqa: F401
 
 
 def format_number(n):
@@ -29,20 +32,164 @@ def natural_sort(ar):
     >>> natural_sort('1 10 20 2 3 4'.split())
     ['1', '2', '3', '4', '10', '20']
     '''
-    to_sort = []
-    for item in ar:
-        spl = re.split('(\d+)', item)
-        l2 = []
-        for el in spl:
-            try:
-                n = int(el)
-            except:
-                n = el
-            l2.append(n)
-        to_sort.append((l2, item))
+    return sorted(ar, key=lambda item: (natural_key(item), item))
+
+
+_natural_split = re.compile(r'(\d+)')
+
+
+@memoize(maxsize=10000)
+def natural_key(item):
+    '''
+    The sort key used by natural_sort (cached, since the same chromosome names
+    are used over and over)
+
+    >>> natural_key('chr10_random')
+    ('chr', 10, '_random')
+    '''
+    key = []
+    for el in _natural_split.split(item):
+        if el.isdigit():
+            key.append(int(el))
+        elif el:
+            key.append(el)
+    return tuple(key)
 
-    to_sort.sort()
-    return [x[1] for x in to_sort]
+
+# the position column (after the chromosome name) for each format
+_position_columns = {'bed': 1, 'gff': 3, 'gtf': 3, 'scidx': 1}
+
+
+def position_key(fmt):
+    '''
+    Returns a sort key function for the lines of a BED, GFF/GTF or scidx file:
+    (natural chromosome key, start position).
+
+    >>> key = position_key('bed')
+    >>> key('chr2\\t100\\t200\\n') < key('chr10\\t50\\t60\\n')
+    True
+    '''
+    col = _position_columns[fmt]
+    chrom_keys = {}
+
+    def key(line):
+        cols = line.split('\t', col + 1)
+        try:
+            return (chrom_keys[cols[0]], int(cols[col]))
+        except KeyError:
+            chrom_keys[cols[0]] = natural_key(cols[0])
+            return (chrom_keys[cols[0]], int(cols[col]))
+
+    return key
+
+
+def _is_header(line):
+    return not line.strip() or line[0] == '#' or line.startswith('track') or line.startswith('browser') or line.startswith('chrom\t')
+
+
+def merge_sorted(iterables, key=None):
+    '''
+    Merges already sorted iterables (k-way, with a heap) into one sorted
+    iterator. Values with the same key are returned in the order of the
+    iterables. Raises ValueError if an iterable isn't sorted.
+
+    >>> list(merge_sorted([[1, 4, 9], [2, 3, 10], [], [5]]))
+    [1, 2, 3, 4, 5, 9, 10]
+    >>> list(merge_sorted([['chr2', 'chr10'], ['chr1', 'chrX']], key=natural_key))
+    ['chr1', 'chr2', 'chr10', 'chrX']
+    '''
+    heap = []
+    for i, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for value in iterator:
+            heap.append([key(value) if key else value, i, value, iterator])
+            break
+
+    heapq.heapify(heap)
+
+    while heap:
+        entry = heap[0]
+        yield entry[2]
+
+        for value in entry[3]:
+            value_key = key(value) if key else value
+            if value_key < entry[0]:
+                raise ValueError('Input %s is not sorted: %r' % (entry[1] + 1, value))
+            entry[0] = value_key
+            entry[2] = value
+            heapq.heapreplace(heap, entry)
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def merge_sorted_files(fnames, fmt='bed'):
+    '''
+    Merges BED, GFF/GTF or scidx files that are already sorted by chromosome
+    (naturally sorted, see natural_sort) and start position. Yields the
+    lines, without the headers or comments.
+    '''
+    files = [gzip_aware_open(fname) for fname in fnames]
+    try:
+        for line in merge_sorted([(line for line in f if not _is_header(line)) for f in files], key=position_key(fmt)):
+            yield line
+    finally:
+        for f in files:
+            if f != sys.stdin:
+                f.close()
+
+
+def external_sort(lines, key=None, max_lines=1000000, tmpdir=None):
+    '''
+    Sorts lines (stable), using no more than {max_lines} lines of memory. The
+    lines are sorted in runs of {max_lines}; if there is more than one run,
+    the runs are written to temporary files and merged. A newline is added to
+    the last line if it doesn't have one, so every line ends with a newline.
+
+    >>> list(external_sort(['3\\n', '1\\n', '2\\n', '10\\n'], key=int, max_lines=2))
+    ['1\\n', '2\\n', '3\\n', '10\\n']
+    >>> list(external_sort(['3\\n', '1\\n', '2'], key=int, max_lines=10))
+    ['1\\n', '2\\n', '3\\n']
+    >>> list(external_sort(['3\\n', '1\\n', '2'], key=int, max_lines=1))
+    ['1\\n', '2\\n', '3\\n']
+    '''
+    runs = []
+    buf = []
+    try:
+        for line in lines:
+            if line[-1:] != '\n':
+                line += '\n'
+            buf.append(line)
+            if len(buf) >= max_lines:
+                runs.append(_sorted_run(buf, key, tmpdir))
+                buf = []
+
+        buf.sort(key=key)
+        if not runs:
+            for line in buf:
+                yield line
+            return
+
+        if buf:
+            runs.append(buf)
+        buf = None
+
+        for line in merge_sorted(runs, key=key):
+            yield line
+    finally:
+        for run in runs:
+            if not isinstance(run, list):
+                run.close()
+
+
+def _sorted_run(buf, key, tmpdir):
+    'Sorts a run of lines and writes it to a temporary file'
+    buf.sort(key=key)
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    for line in buf:
+        run.write(line)
+    run.seek(0)
+    return run
 
 
 def dictify(values, colnames):
@@ -93,7 +240,7 @@ def gzip_aware_open(fname):
     if fname == '-':
         f = sys.stdin
     elif fname[-3:] == '.gz' or fname[-4:] == '.bgz':
-        f = gzip.open(os.path.expanduser(fname))
+        f = ngsutils.support.bgzip.bgzf_aware_open(os.path.expanduser(fname))
     else:
         f = open(os.path.expanduser(fname))
     return f
@@ -202,24 +349,3 @@ def parse_args(argv, defaults=None, expected_argc=0):
     while len(args) < expected_argc:
         args.append(None)
     return opts, args
-
-
-class memoize(object):
-    'Simple memoizing decorator to cache results'
-
-    def __init__(self, func):
-        self.func = func
-        self.cache = {}
-
-    def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
-            # uncacheable. a list, for instance.
-            # better to not cache than blow up.
-            return self.func(*args)
-
-        if args in self.cache:
-            return self.cache[args]
-        else:
-            value = self.func(*args)
-            self.cache[args] = value
-            return value
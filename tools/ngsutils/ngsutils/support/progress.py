@@ -0,0 +1,143 @@
+'''
+Sampled progress reporting for long running iterators (bam_iter,
+bam_pileup_iter, gzip_reader).
+
+The iterator updates a Progress object every {every} records (not on every
+record). At most once every {seconds} seconds, the Progress object passes a
+dict of metrics to each of its hooks:
+
+    records         number of records read so far
+    records_per_sec records/sec since the last report
+    offset          position in the input: the compressed file offset in
+                    bytes (or bases into the region for bam_iter with ref)
+    offset_per_sec  offset/sec since the last report (bytes/sec)
+    total           the size of the input (if known)
+    elapsed         seconds since the start
+    extra           status text from the iterator (chrom:pos, read name)
+    done            True for the final report
+
+A hook is any callable that takes the metrics dict (and optionally has a
+done() method). ETAHook shows the usual progress bar on the terminal (needs
+the eta package), JSONLinesHook writes each report as a line of JSON:
+
+    progress = Progress([JSONLinesHook('metrics.jsonl')], every=10000, seconds=30)
+    for read in bam_iter(bam, progress=progress):
+        ...
+'''
+
+import json
+import time
+
+try:
+    from eta import ETA
+except ImportError:
+    ETA = None
+
+
+class Progress(object):
+    def __init__(self, hooks, total=None, every=1000, seconds=1.0):
+        self.hooks = hooks
+        self.total = total
+        self.every = every
+        self.seconds = seconds
+
+        self.records = 0
+        self.offset = None
+        self.start = time.time()
+
+        self._last_time = self.start
+        self._last_records = 0
+        self._last_offset = 0
+
+    def update(self, records, offset=None, extra=None):
+        '''
+        Called by the iterator with the number of records read since the last
+        update. extra can also be a function that returns the status text
+        (only called if the hooks are run).
+        '''
+        self.records += records
+        if offset is not None:
+            self.offset = offset
+
+        now = time.time()
+        if now - self._last_time >= self.seconds:
+            self._report(now, extra)
+
+    def done(self, records=0, offset=None, extra=None):
+        'Called by the iterator when it is finished'
+        self.records += records
+        if offset is not None:
+            self.offset = offset
+
+        self._report(time.time(), extra, True)
+
+        for hook in self.hooks:
+            if hasattr(hook, 'done'):
+                hook.done()
+
+    def _report(self, now, extra, done=False):
+        if callable(extra):
+            extra = extra()
+
+        elapsed = now - self._last_time
+        offset = self.offset or 0
+
+        metrics = {
+            'records': self.records,
+            'records_per_sec': (self.records - self._last_records) / elapsed if elapsed else 0.0,
+            'offset': self.offset,
+            'offset_per_sec': (offset - self._last_offset) / elapsed if elapsed else 0.0,
+            'total': self.total,
+            'elapsed': now - self.start,
+            'extra': extra,
+            'done': done,
+        }
+
+        self._last_time = now
+        self._last_records = self.records
+        self._last_offset = offset
+
+        for hook in self.hooks:
+            hook(metrics)
+
+
+class ETAHook(object):
+    'Shows the progress on the terminal with the eta package'
+    def __init__(self, total):
+        self.eta = ETA(total)
+
+    def __call__(self, metrics):
+        if not metrics['done']:
+            self.eta.print_status(metrics['offset'], extra=metrics['extra'] or '')
+
+    def done(self):
+        self.eta.done()
+
+
+class JSONLinesHook(object):
+    'Writes each report as a line of JSON to a file (name or file object)'
+    def __init__(self, out):
+        if isinstance(out, str):
+            self.out = open(out, 'w')
+            self._close = True
+        else:
+            self.out = out
+            self._close = False
+
+    def __call__(self, metrics):
+        self.out.write('%s\n' % json.dumps(metrics, sort_keys=True))
+        self.out.flush()
+
+    def done(self):
+        if self._close:
+            self.out.close()
+
+
+def default_progress(total):
+    '''
+    The progress bar used by the iterators when they aren't quiet (or None if
+    the eta package isn't installed)
+    '''
+    if ETA is None:
+        return None
+    return Progress([ETAHook(total)], total=total, every=1000, seconds=0.5)
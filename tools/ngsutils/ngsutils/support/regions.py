@@ -1,3 +1,8 @@
+import bisect
+import heapq
+import operator
+
+
 class RangeMatch(object):
     '''
     Simple genomic ranges.  You can define chrom:start-end ranges, then ask if a
@@ -16,13 +21,13 @@ class RangeMatch(object):
         bin = start / 100000
         if bin not in self.ranges[chrom]:
             self.ranges[chrom][bin] = []
-        self.ranges[chrom][bin].insert(0, (start, end, strand))
+        self.ranges[chrom][bin].append((start, end, strand))
 
         if (end / 100000) != bin:
             for bin in xrange(bin + 1, (end / 100000) + 1):
                 if bin not in self.ranges[chrom]:
                     self.ranges[chrom][bin] = []
-                self.ranges[chrom][bin].insert(0, (start, end, strand))
+                self.ranges[chrom][bin].append((start, end, strand))
 
     def get_tag(self, chrom, strand, pos, ignore_strand=False):
         '''
@@ -33,7 +38,8 @@ class RangeMatch(object):
         bin = pos / 100000
         if bin not in self.ranges[chrom]:
             return None, False
-        for start, end, r_strand in self.ranges[chrom][bin]:
+        # the most recently added range wins
+        for start, end, r_strand in reversed(self.ranges[chrom][bin]):
             if pos >= start and pos <= end:
                 if ignore_strand or strand == r_strand:
                     return self.name, False
@@ -41,51 +47,160 @@ class RangeMatch(object):
         return None, False
 
 
+class RegionIndex(object):
+    '''
+    A merged index of genomic ranges with priorities. Each chromosome is split
+    into sorted, non-overlapping segments, each labeled with the range that
+    wins at that position: the range with the lowest priority value, and for
+    ranges with the same priority, the one added last (same as RangeMatch).
+    A lookup is then a single bisect, no matter how many ranges overlap.
+
+    Ranges are inclusive (start <= pos <= end), like RangeMatch.
+
+    >>> index = RegionIndex()
+    >>> index.add_range('chr1', 100, 200, 'exon', 1)
+    >>> index.add_range('chr1', 150, 160, 'coding', 0)
+    >>> index.add_range('chr1', 180, 300, 'intron', 2)
+    >>> index.build()
+    >>> [index.get('chr1', pos) for pos in (99, 100, 150, 160, 161, 200, 201, 300, 301)]
+    [None, 'exon', 'coding', 'coding', 'exon', 'exon', 'intron', 'intron', None]
+    >>> index.get('chr2', 150) is None
+    True
+    '''
+
+    def __init__(self):
+        self._ranges = {}
+        self._chroms = {}
+        self._count = 0
+
+    def add_range(self, chrom, start, end, label, priority=0):
+        self.add_ranges(chrom, [(start, end)], label, priority)
+
+    def add_ranges(self, chrom, ranges, label, priority=0):
+        'Adds a list of (start, end) ranges with the same label'
+        if chrom not in self._ranges:
+            self._ranges[chrom] = {}
+        chrom_ranges = self._ranges[chrom]
+
+        # identical ranges are only stored once (the last one added wins)
+        for start, end in ranges:
+            if end >= start:
+                self._count += 1
+                chrom_ranges[(start, end + 1, priority, label)] = self._count
+
+    def build(self):
+        '''
+        Builds the segments (after all ranges are added). This is a sweep over
+        the ranges sorted by start, with a heap of the active ranges (best
+        first). The label can only change where a range starts, or where the
+        best active range ends.
+        '''
+        self._chroms = {}
+        scale = self._count + 1
+
+        for chrom, chrom_ranges in self._ranges.iteritems():
+            # rank: lower is better (by priority, then the last added)
+            ranges = [(start, end, priority * scale - order, label) for (start, end, priority, label), order in chrom_ranges.iteritems()]
+            ranges.sort(key=operator.itemgetter(0))
+
+            starts = []
+            labels = []
+            active = []
+            i = 0
+            count = len(ranges)
+
+            while i < count or active:
+                if active and (i >= count or active[0][1] < ranges[i][0]):
+                    pos = active[0][1]
+                else:
+                    pos = ranges[i][0]
+                    while i < count and ranges[i][0] == pos:
+                        start, end, rank, label = ranges[i]
+                        heapq.heappush(active, (rank, end, label))
+                        i += 1
+
+                while active and active[0][1] <= pos:
+                    heapq.heappop(active)
+
+                label = active[0][2] if active else None
+                if not labels or labels[-1] != label:
+                    starts.append(pos)
+                    labels.append(label)
+
+            self._chroms[chrom] = (starts, labels)
+
+        self._ranges = {}
+
+    def get(self, chrom, pos):
+        'Returns the label at chrom:pos (or None)'
+        if chrom not in self._chroms:
+            return None
+        starts, labels = self._chroms[chrom]
+        i = bisect.bisect_right(starts, pos) - 1
+        if i < 0:
+            return None
+        return labels[i]
+
+    def segments(self, chrom):
+        'Yields (start, end, label) for each labeled segment (end exclusive)'
+        starts, labels = self._chroms[chrom]
+        for i, label in enumerate(labels):
+            if label is not None:
+                yield starts[i], starts[i + 1], label
+
+
 class RegionTagger(object):
+    '''
+    Tags reads (or regions) by the gene model features they overlap, in
+    order: coding, utr-5, utr-3, other-exon, intron, promoter. The features
+    for all genes are merged into one RegionIndex, so tagging a read is a
+    single lookup.
+    '''
+    _priorities = ['coding', 'utr-5', 'utr-3', 'other-exon', 'intron', 'promoter']
+
     def __init__(self, gtf, valid_chroms=None, only_first_fragment=True):
-        self.regions = []
         self.counts = {}
         self.only_first_fragment = only_first_fragment
+        self.index = RegionIndex()
+
+        add_ranges = self.index.add_ranges
+        labels = {}
+        for name in RegionTagger._priorities:
+            for strand in '+-':
+                labels[(name, strand)] = (name, strand)
 
-        coding = RangeMatch('coding')
-        exons = RangeMatch('other-exon')
-        utr_5 = RangeMatch('utr-5')
-        utr_3 = RangeMatch('utr-3')
-        introns = RangeMatch('intron')
-        promoters = RangeMatch('promoter')
+        coding, utr_5, utr_3, exons, introns, promoters = range(len(RegionTagger._priorities))
 
         for gene in gtf.genes:
             if valid_chroms and gene.chrom not in valid_chroms:
                 continue
-            if gene.strand == '+':
-                promoters.add_range(gene.chrom, gene.strand, gene.start - 2000, gene.start)
+            chrom = gene.chrom
+            strand = gene.strand
+
+            if strand == '+':
+                add_ranges(chrom, [(gene.start - 2000, gene.start)], labels[('promoter', strand)], promoters)
             else:
-                promoters.add_range(gene.chrom, gene.strand, gene.end, gene.end + 2000)
+                add_ranges(chrom, [(gene.end, gene.end + 2000)], labels[('promoter', strand)], promoters)
 
             for transcript in gene.transcripts:
                 if transcript.has_cds:
-                    for start, end in transcript.cds:
-                        coding.add_range(gene.chrom, gene.strand, start, end)
+                    add_ranges(chrom, transcript.cds, labels[('coding', strand)], coding)
 
                     # TODO: Fix this so that it iterates over exons in the 5'/3' UTRS
-                    for s, e in transcript.utr_5:
-                        utr_5.add_range(gene.chrom, gene.strand, s, e)
-                    for s, e in transcript.utr_3:
-                        utr_3.add_range(gene.chrom, gene.strand, s, e)
+                    add_ranges(chrom, transcript.utr_5, labels[('utr-5', strand)], utr_5)
+                    add_ranges(chrom, transcript.utr_3, labels[('utr-3', strand)], utr_3)
 
                 last_end = None
+                transcript_introns = []
                 for start, end in transcript.exons:
                     if last_end:
-                        introns.add_range(gene.chrom, gene.strand, last_end, start)
-                    exons.add_range(gene.chrom, gene.strand, start, end)
+                        transcript_introns.append((last_end, start))
                     last_end = end
 
-        self.regions.append(coding)
-        self.regions.append(utr_5)
-        self.regions.append(utr_3)
-        self.regions.append(exons)
-        self.regions.append(introns)
-        self.regions.append(promoters)
+                add_ranges(chrom, transcript_introns, labels[('intron', strand)], introns)
+                add_ranges(chrom, transcript.exons, labels[('other-exon', strand)], exons)
+
+        self.index.build()
 
         self.counts['coding'] = 0
         self.counts['coding-rev'] = 0
@@ -103,6 +218,15 @@ class RegionTagger(object):
         self.counts['intergenic'] = 0
         self.counts['mitochondrial'] = 0
 
+    def _get_tag(self, chrom, strand, pos):
+        '''
+        returns (region, is_reverse_orientation)
+        '''
+        label = self.index.get(chrom, pos)
+        if label is None:
+            return None, False
+        return label[0], label[1] != strand
+
     def add_read(self, read, chrom):
         if read.is_unmapped:
             return
@@ -125,10 +249,7 @@ class RegionTagger(object):
                     break
 
         if not tag:
-            for region in self.regions:
-                tag, is_rev = region.get_tag(chrom, strand, read.pos)
-                if tag:
-                    break
+            tag, is_rev = self._get_tag(chrom, strand, read.pos)
 
         if not tag:
             tag = 'intergenic'
@@ -142,25 +263,29 @@ class RegionTagger(object):
         return tag
 
     def tag_region(self, chrom, start, end, strand):
+        '''
+        Returns the tag at start, or 'starttag/endtag' if the region starts and
+        ends in different features.
+        '''
         tag = None
-        is_rev = False
 
         if chrom == 'chrM' or chrom == 'M':
             tag = 'mitochondrial'
 
         if not tag:
-            for region in self.regions:
-                tag, is_rev = region.get_tag(chrom, strand, start)
-                if is_rev:
-                    tag = '%s-rev' % tag
+            tag, is_rev = self._get_tag(chrom, strand, start)
+            if is_rev:
+                tag = '%s-rev' % tag
 
-                if start != end:
-                    endtag, is_rev = region.get_tag(chrom, strand, end)
-                    if is_rev:
-                        endtag = '%s-rev' % endtag
+            if tag and start != end:
+                endtag, is_rev = self._get_tag(chrom, strand, end)
+                if is_rev:
+                    endtag = '%s-rev' % endtag
 
-                if tag and endtag and endtag != tag:
+                if endtag and endtag != tag:
                     tag = '%s/%s' % (tag, endtag)
 
         if not tag:
             tag = 'intergenic'
+
+        return tag
@@ -5,6 +5,11 @@ import math
 
 from ngsutils.support import memoize
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def median(vals):
     '''
@@ -160,6 +165,110 @@ def _factorial(x):
     '''
     return math.factorial(x)
 
+
+# Array versions of the above, for calculating the stats for many positions
+# (or samples) in one call. These need numpy.
+
+def _require_numpy(name):
+    if numpy is None:
+        raise ImportError('numpy is required for %s' % name)
+
+
+def median_array(vals, axis=-1):
+    '''
+    median for each row of an array (vals isn't sorted in place)
+
+    >>> median_array([[1, 2, 3], [4, 1, 2]])
+    array([2., 2.])
+    >>> median_array([[1, 2, 3, 4]])
+    array([2.5])
+    '''
+    _require_numpy('median_array')
+    return numpy.median(vals, axis=axis)
+
+
+def mean_stdev_array(vals, axis=-1):
+    '''
+    mean_stdev for each row of an array. Returns (means, stdevs).
+
+    >>> mean_stdev_array([[1, 2, 2, 2], [2, 2, 2, 2]])
+    (array([1.75, 2.  ]), array([0.5, 0. ]))
+    '''
+    _require_numpy('mean_stdev_array')
+    vals = numpy.asarray(vals, dtype=numpy.float64)
+    mean = vals.mean(axis=axis)
+
+    if vals.shape[axis] > 2:
+        stdev = vals.std(axis=axis, ddof=1)
+    else:
+        stdev = numpy.zeros_like(mean)
+
+    return (mean, stdev)
+
+
+def counts_mean_stdev_array(counts, vals=None):
+    '''
+    counts_mean_stdev for each row of an array of counts, where counts[..., k]
+    is the number of times vals[k] was seen (vals defaults to 0, 1, 2, ...).
+    Returns (means, stdevs). Rows with no counts have a mean of nan.
+
+    >>> counts_mean_stdev_array([[0, 4, 1, 4], [0, 0, 3, 0]])
+    (array([2., 2.]), array([1., 0.]))
+    >>> counts_mean_stdev_array([[4, 1, 4]], vals=[1, 2, 3])
+    (array([2.]), array([1.]))
+    '''
+    _require_numpy('counts_mean_stdev_array')
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    if vals is None:
+        vals = numpy.arange(counts.shape[-1], dtype=numpy.float64)
+    else:
+        vals = numpy.asarray(vals, dtype=numpy.float64)
+
+    count = counts.sum(axis=-1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = (counts * vals).sum(axis=-1) / count
+        acc = (((vals - mean[..., numpy.newaxis]) ** 2) * counts).sum(axis=-1)
+        stdev = numpy.where(count > 2, numpy.sqrt(acc / (count - 1)), 0.0)
+
+    return (mean, stdev)
+
+
+def poisson_prob_array(x, mean):
+    '''
+    poisson_prob for arrays of counts and means (either can also be a single
+    value). The terms are calculated in log space, so large counts don't
+    overflow. The time taken is proportional to the sum of the counts.
+
+    >>> poisson_prob_array([6, 8, 0], 10)
+    array([0.13009602, 0.33277428, 0.        ])
+    >>> numpy.allclose(poisson_prob_array(6, [10, 2.5]), [poisson_prob(6, 10), poisson_prob(6, 2.5)])
+    True
+    '''
+    _require_numpy('poisson_prob_array')
+    x, mean = numpy.broadcast_arrays(numpy.asarray(x, dtype=numpy.int64), numpy.asarray(mean, dtype=numpy.float64))
+    shape = x.shape
+    x = x.ravel()
+    mean = mean.ravel()
+
+    # largest counts first, so the values still summing at term i are x[:n]
+    order = numpy.argsort(-x, kind='mergesort')
+    x = x[order]
+    mean = mean[order]
+    with numpy.errstate(divide='ignore'):
+        log_mean = numpy.log(mean)
+
+    acc = numpy.zeros(len(x))
+    n = len(x)
+    for i in xrange(1, x[0] + 1 if n else 0):
+        while x[n - 1] < i:
+            n -= 1
+        acc[:n] += numpy.exp(i * log_mean[:n] - mean[:n] - math.lgamma(i + 1))
+
+    out = numpy.empty(len(x))
+    out[order] = acc
+    return out.reshape(shape)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()